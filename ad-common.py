@@ -0,0 +1,651 @@
+#!/usr/bin/python
+
+import boto3
+import json
+import os
+import time
+import datetime
+import contextlib
+import functools
+import threading
+import math
+import collections
+import gc
+import cProfile
+import pstats
+import StringIO
+import resource
+import multiprocessing
+import array
+import struct
+import sys
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Table keys, the packed file format, the rollup tree, metrics, profiling,
+# deadline budgeting, S3 outputs and worker processes shared by get-data.py,
+# process-data.py and publish-data.py, which load this file from their own
+# directory with imp.load_source. It keeps no state of its own: each function
+# has its own Metrics, Profiler and Deadline costs.
+
+# Metrics are emitted once per invocation as a CloudWatch Embedded Metric
+# Format record on stdout, which CloudWatch Logs turns into metrics under
+# METRICS_NAMESPACE, and appended as a JSON line to METRICS_FILE if set
+METRICS_NAMESPACE = 'aws-lambda/ad'
+METRICS_FILE = os.environ.get('AD_METRICS_FILE')
+# Timer histogram buckets per doubling, and samples emitted per timer
+METRICS_BUCKETS = 4
+METRICS_MAX_VALUES = 100
+
+# Profiling is off unless the event has 'profile' set or AD_PROFILE is set.
+# The handler, and its worker processes and fetch thread if any, then run
+# under cProfile and tracemalloc, where the latter is available. The stats
+# and a summary of the hottest functions and of memory go to PROFILE_DIR,
+# and to the 'profile_bucket' of the event or PROFILE_BUCKET. The memory
+# summary lists the top allocators under tracemalloc; without it (Python 2)
+# it has the peak RSS and the types of the objects gc tracks that grew most.
+PROFILE = os.environ.get('AD_PROFILE')
+PROFILE_DIR = os.environ.get('AD_PROFILE_DIR', '/tmp/ad-profile')
+PROFILE_BUCKET = os.environ.get('AD_PROFILE_BUCKET')
+PROFILE_TOP = 40
+PROFILE_FRAMES = 10
+
+# Weight of the latest measurement in a unit's cost
+COST_DECAY = 0.3
+
+# Rollup tree levels, largest first, of the rollups publish-data.py merges
+# and process-data.py deletes when it adds parts. Years hold quarters,
+# quarters hold months and months hold the weeks starting on days 1, 8, 15
+# and 22 plus days 29 to the end of the month, so weeks never cross months.
+NODE_TYPES = ['year', 'quarter', 'month', 'week', 'day']
+ONE_DAY = datetime.timedelta(days=1)
+
+# Two part keys are one int, the first id in the high KEY_BITS bits: they
+# hash and compare as ints and sort as the (id, id) tuples they stand for.
+# process-data.py counts packed keys and publish-data.py merges them, both
+# only unpack them when a file is written.
+KEY_BITS = 16
+KEY_MASK = (1 << KEY_BITS) - 1
+
+# Part and rollup files are CSV or packed: PACKED_MAGIC followed by a zlib
+# stream of the CSV header line and the number of key columns, then blocks
+# of up to PACKED_BLOCK_ROWS rows, each being its number of rows and the key,
+# total and wins columns as little-endian uint32 arrays. Rows are sorted by
+# key, and two part keys are stored as two key columns.
+PACKED_MAGIC = 'ADP1'
+PACKED_BLOCK_ROWS = 65536
+# Bytes read at once from files and S3 objects
+READ_CHUNK = 1 << 20
+
+# Outputs are uploaded as they are written, in multipart upload parts of
+# S3_PART_BYTES (at least 5MB), or with one PUT when smaller
+S3_PART_BYTES = 8 * 1024 * 1024
+
+def log(message):
+    print datetime.datetime.now().isoformat() + ' | ' + str(message)
+
+def pack_key(k1, k2):
+    return (k1 << KEY_BITS) | k2
+
+def unpack_key(key):
+    return key >> KEY_BITS, key & KEY_MASK
+
+def get_next_month(date):
+    if date.month < 12:
+        return datetime.date(year=date.year, month=date.month+1, day=1)
+    else:
+        return datetime.date(year=date.year+1, month=1, day=1)
+
+def node_start(date, node_type):
+    ''' Start of the node_type node holding date, None if there is none '''
+    if node_type == 'year':
+        return date.replace(month=1, day=1)
+    if node_type == 'quarter':
+        return date.replace(month=(date.month - 1) // 3 * 3 + 1, day=1)
+    if node_type == 'month':
+        return date.replace(day=1)
+    if node_type == 'week':
+        if date.day > 28:
+            return None
+        return date.replace(day=(date.day - 1) // 7 * 7 + 1)
+    return date
+
+def node_end(node):
+    date, node_type = node
+    if node_type == 'year':
+        return date.replace(month=12, day=31)
+    if node_type == 'quarter':
+        return get_next_month(get_next_month(get_next_month(date))) - ONE_DAY
+    if node_type == 'month':
+        return get_next_month(date) - ONE_DAY
+    if node_type == 'week':
+        return date + 6 * ONE_DAY
+    return date
+
+def node_name(node):
+    ''' S3 prefix of a node's rollups '''
+    date, node_type = node
+    if node_type == 'year':
+        return str(date.year)
+    if node_type == 'quarter':
+        return '%d-Q%d' % (date.year, (date.month - 1) // 3 + 1)
+    if node_type == 'month':
+        return datetime.datetime.strftime(date, '%Y-%m')
+    if node_type == 'week':
+        return datetime.datetime.strftime(date, '%Y-%m') + '-W%d' % ((date.day - 1) // 7 + 1)
+    return str(date)
+
+def node_children(node):
+    date, node_type = node
+    if node_type == 'year':
+        return [(date.replace(month=month), 'quarter') for month in (1, 4, 7, 10)]
+    if node_type == 'quarter':
+        return [(date.replace(month=date.month + i), 'month') for i in range(3)]
+    if node_type == 'month':
+        return ([(date.replace(day=day), 'week') for day in (1, 8, 15, 22)] +
+                [(date.replace(day=day), 'day') for day in range(29, node_end(node).day + 1)])
+    if node_type == 'week':
+        return [(date + i * ONE_DAY, 'day') for i in range(7)]
+    return []
+
+def split_date_ranges(start_date, end_date):
+    ''' list of tuples (start_date, type=NODE_TYPES), the largest nodes
+    covering start_date to end_date '''
+    if start_date > end_date:
+        raise Exception("start_date > end_date")
+
+    date_ranges = list()
+    current_date = start_date
+    while current_date <= end_date:
+        for node_type in NODE_TYPES:
+            node = (current_date, node_type)
+            if node_start(current_date, node_type) == current_date and node_end(node) <= end_date:
+                break
+        date_ranges.append(node)
+        current_date = node_end(node) + ONE_DAY
+
+    return date_ranges
+
+class Metrics(object):
+    ''' Counters, gauges and timer histograms of an invocation, see
+    METRICS_FILE
+
+    Timers keep how many samples fell in each of METRICS_BUCKETS buckets per
+    doubling of milliseconds. They are emitted as up to METRICS_MAX_VALUES
+    bucket values repeated in proportion to their counts, for CloudWatch's
+    percentiles, and in full as <name>Histogram. Work done in another process
+    is added with merge(pop()) from there.
+    '''
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    def count(self, name, value=1, unit='Count'):
+        with self.lock:
+            if name in self.counters:
+                self.counters[name][0] += value
+            else:
+                self.counters[name] = [value, unit]
+
+    def gauge(self, name, value, unit='None'):
+        ''' A value such as a rate, which adding up makes no sense of. Kept
+        as a list, so that counting and merging put the values side by side,
+        each emitted as a data point of its own. '''
+        self.count(name, [value], unit)
+
+    def time(self, name, seconds):
+        milliseconds = seconds * 1000.0
+        bucket = 0.0
+        if milliseconds > 0:
+            bucket = round(2 ** (round(math.log(milliseconds, 2) * METRICS_BUCKETS) / METRICS_BUCKETS), 3)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, dict())
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        timer_start_time = time.time()
+        yield
+        self.time(name, time.time() - timer_start_time)
+
+    def pop(self):
+        ''' What was recorded since the last pop(), see merge() '''
+        with self.lock:
+            state = (self.counters, self.histograms)
+            self.counters = dict()
+            self.histograms = dict()
+        return state
+
+    def merge(self, state):
+        counters, histograms = state
+        for name, (value, unit) in counters.iteritems():
+            self.count(name, value, unit)
+        with self.lock:
+            for name, other in histograms.iteritems():
+                histogram = self.histograms.setdefault(name, dict())
+                for bucket, count in other.iteritems():
+                    histogram[bucket] = histogram.get(bucket, 0) + count
+
+    def record(self, counters, histograms):
+        record = {'Function': self.function_name}
+        definitions = list()
+        for name, (value, unit) in sorted(counters.iteritems()):
+            record[name] = value
+            definitions.append({'Name': name, 'Unit': unit})
+        for name, histogram in sorted(histograms.iteritems()):
+            n_samples = sum(histogram.itervalues())
+            scale = max(0.0, min(1.0, float(METRICS_MAX_VALUES - len(histogram)) / n_samples))
+            values = list()
+            for bucket in sorted(histogram):
+                values += [bucket] * max(1, int(histogram[bucket] * scale))
+            record[name] = values
+            record[name + 'Histogram'] = dict((str(bucket), count) for bucket, count in histogram.iteritems())
+            definitions.append({'Name': name, 'Unit': 'Milliseconds'})
+
+        # At most 100 metrics per directive
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': definitions[i:i + 100],
+                }
+                for i in range(0, len(definitions), 100)
+            ],
+        }
+        return record
+
+    def flush(self):
+        ''' Emit and reset what was recorded '''
+        counters, histograms = self.pop()
+        if not counters and not histograms:
+            return
+        line = json.dumps(self.record(counters, histograms), sort_keys=True)
+        print line
+        if METRICS_FILE:
+            with open(METRICS_FILE, 'a') as fd:
+                fd.write(line + '\n')
+
+def emit_metrics(metrics):
+    ''' Decorates a handler to flush metrics however it exits '''
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event={}, context={}):
+            try:
+                return handler(event, context)
+            finally:
+                metrics.flush()
+        return wrapper
+    return decorator
+
+def object_counts():
+    ''' Counter of the objects gc tracks, containers only, by type name '''
+    return collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+
+class Profiler(object):
+    ''' Profiles a function's handler when asked to, see PROFILE
+
+    While a profiled handler runs, name is the prefix of its artifacts, for
+    its workers to profile themselves under too.
+    '''
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.name = None
+
+    def call(self, name, function, *args):
+        ''' function(*args) under cProfile and tracemalloc, writing name.prof, the
+        raw pstats, and name.txt, the summary, to PROFILE_DIR '''
+        profile = cProfile.Profile()
+        if tracemalloc:
+            tracemalloc.start(PROFILE_FRAMES)
+        else:
+            start_counts = object_counts()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            if not os.path.isdir(PROFILE_DIR):
+                os.makedirs(PROFILE_DIR)
+            filename = os.path.join(PROFILE_DIR, name)
+            profile.dump_stats(filename + '.prof')
+
+            summary = StringIO.StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+            if tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                summary.write('Top allocators\n')
+                for statistic in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                    summary.write(str(statistic) + '\n')
+            else:
+                summary.write('No tracemalloc, peak RSS ' +
+                              str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) + ' kB\n')
+                summary.write('Objects tracked by gc, growth during the call and count by type\n')
+                counts = object_counts()
+                for type_name, growth in (counts - start_counts).most_common(PROFILE_TOP):
+                    summary.write('%+10d %10d %s\n' % (growth, counts[type_name], type_name))
+            with open(filename + '.txt', 'w') as fd:
+                fd.write(summary.getvalue())
+            log('profile written to ' + filename + '.txt')
+
+    def profiled(self, handler):
+        ''' Decorates a handler to profile it when asked to '''
+        @functools.wraps(handler)
+        def wrapper(event={}, context={}):
+            if self.name or not event.get('profile', PROFILE):
+                return handler(event, context)
+
+            self.name = self.function_name + '-' + datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+            try:
+                return self.call(self.name, handler, event, context)
+            finally:
+                bucket = event.get('profile_bucket', PROFILE_BUCKET)
+                if bucket:
+                    s3_client = boto3.client('s3')
+                    for name in sorted(os.listdir(PROFILE_DIR)):
+                        if name.startswith(self.name):
+                            log('uploading ' + bucket + '/profile/' + name)
+                            s3_client.upload_file(os.path.join(PROFILE_DIR, name), bucket, 'profile/' + name)
+                self.name = None
+        return wrapper
+
+class Deadline(object):
+    ''' When the invocation has to be done by and what its units of work cost
+
+    The end is the Lambda deadline less reserve seconds, or start_time +
+    timeout without a context, never with no timeout. Unit costs start from
+    unit_costs and are moving averages of measured durations, kept in costs
+    across warm invocations, so a new timeout or memory size is used in full
+    without touching the constants.
+    '''
+    def __init__(self, context, start_time, timeout, reserve, unit_costs, costs):
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time:
+            self.end = time.time() + get_remaining_time() / 1000.0 - reserve
+        elif timeout is not None:
+            self.end = start_time + timeout
+        else:
+            self.end = float('inf')
+        self.unit_costs = unit_costs
+        self.costs = costs
+
+    def remaining(self):
+        return self.end - time.time()
+
+    def cost(self, unit):
+        return self.costs.get(unit, self.unit_costs[unit])
+
+    def record(self, unit, seconds):
+        if unit in self.costs:
+            self.costs[unit] += COST_DECAY * (seconds - self.costs[unit])
+        else:
+            self.costs[unit] = seconds
+
+    @contextlib.contextmanager
+    def timed(self, unit):
+        unit_start_time = time.time()
+        yield
+        self.record(unit, time.time() - unit_start_time)
+
+    def fits(self, *units):
+        ''' Whether units, each a name or a (name, count) pair, fit before the end '''
+        needed = 0
+        for unit in units:
+            name, count = unit if isinstance(unit, tuple) else (unit, 1)
+            needed += self.cost(name) * count
+        return self.remaining() > needed
+
+    def size(self, unit, size):
+        ''' How much of a unit of the given size fits, its cost being for
+        the full size and proportional to it '''
+        return max(0, min(size, int(size * self.remaining() / self.cost(unit))))
+
+class S3Writer(object):
+    ''' File-like object uploading what is written to it as an S3 object
+
+    Data goes out in multipart upload parts of S3_PART_BYTES as it is
+    written; an object smaller than a part is uploaded with one PUT on
+    close. As a context manager the upload is completed on exit, or aborted
+    on an exception, after which the writer can be written from the start
+    again. With copy_filename the data is also written to that file. The
+    bytes uploaded are counted in metrics.
+    '''
+    def __init__(self, s3_client, bucket_name, s3_key, metrics, copy_filename=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.metrics = metrics
+        self.copy_filename = copy_filename
+        self.reset()
+
+    def reset(self):
+        self.buffer = list()
+        self.buffered = 0
+        self.size = 0
+        self.upload_id = None
+        self.parts = list()
+        self.copy = open(self.copy_filename, 'wb') if self.copy_filename else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.copy:
+            self.copy.write(data)
+        if self.buffered >= S3_PART_BYTES:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=''.join(self.buffer),
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = list()
+        self.buffered = 0
+
+    def close(self):
+        if self.copy:
+            self.copy.close()
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.s3_key, Body=''.join(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.s3_key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts},
+            )
+        self.buffer = list()
+        self.metrics.count('BytesUploaded', self.size, 'Bytes')
+
+    def abort(self):
+        if self.copy:
+            self.copy.close()
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key,
+                                                  UploadId=self.upload_id)
+        self.reset()
+
+def open_output(out_file, mode):
+    ''' out_file opened for writing, or itself if it is already a file-like
+    object such as an S3Writer '''
+    if hasattr(out_file, 'write'):
+        return out_file
+    return open(out_file, mode)
+
+def write_packed_rows(rows, out_file, full_header):
+    ''' Write rows, (key, total, wins) in key order, as a packed file with
+    the CSV header line full_header '''
+    n_parts = len(full_header.split(',')) - 2
+    compressor = zlib.compressobj()
+
+    with open_output(out_file, 'wb') as fd:
+        fd.write(PACKED_MAGIC)
+        fd.write(compressor.compress(full_header + struct.pack('<I', n_parts)))
+
+        def write_block(columns):
+            fd.write(compressor.compress(struct.pack('<I', len(columns[-1]))))
+            for column in columns:
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                fd.write(compressor.compress(column.tostring()))
+
+        columns = [array.array('I') for _ in range(n_parts + 2)]
+        for key, total, wins in rows:
+            if n_parts == 2:
+                columns[0].append(key >> KEY_BITS)
+                columns[1].append(key & KEY_MASK)
+            else:
+                columns[0].append(key)
+            columns[-2].append(total)
+            columns[-1].append(wins)
+
+            if len(columns[-1]) == PACKED_BLOCK_ROWS:
+                write_block(columns)
+                columns = [array.array('I') for _ in range(n_parts + 2)]
+
+        if columns[-1]:
+            write_block(columns)
+        fd.write(compressor.flush())
+
+class PackedReader(object):
+    ''' Reads the zlib stream of a packed file as it is needed '''
+    def __init__(self, fd):
+        self.fd = fd
+        self.decompressor = zlib.decompressobj()
+        self.buf = ''
+        self.eof = False
+
+    def fill(self, size):
+        chunks = [self.buf]
+        buf_len = len(self.buf)
+        while buf_len < size and not self.eof:
+            chunk = self.fd.read(READ_CHUNK)
+            if chunk:
+                chunk = self.decompressor.decompress(chunk)
+            else:
+                chunk = self.decompressor.flush()
+                self.eof = True
+            chunks.append(chunk)
+            buf_len += len(chunk)
+        self.buf = ''.join(chunks)
+
+    def read(self, size):
+        self.fill(size)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buf and not self.eof:
+            self.fill(len(self.buf) + 1)
+        return self.read(self.buf.find('\n') + 1 or len(self.buf))
+
+def read_packed_rows(reader, n_parts):
+    with reader.fd:
+        while True:
+            data = reader.read(4)
+            if len(data) < 4:
+                return
+            n_rows, = struct.unpack('<I', data)
+            data = reader.read(4 * n_rows * (n_parts + 2))
+
+            columns = list()
+            for i in range(n_parts + 2):
+                column = array.array('I')
+                column.fromstring(data[4 * n_rows * i:4 * n_rows * (i + 1)])
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                columns.append(column.tolist())
+
+            if n_parts == 2:
+                keys = map(pack_key, columns[0], columns[1])
+            else:
+                keys = columns[0]
+            for row in zip(keys, columns[-2], columns[-1]):
+                yield row
+
+def read_packed(fd):
+    ''' (header, rows) of the packed file fd, read past its PACKED_MAGIC,
+    rows as (key, total, wins) '''
+    reader = PackedReader(fd)
+    header = reader.readline()
+    n_parts, = struct.unpack('<I', reader.read(4))
+    return header, read_packed_rows(reader, n_parts)
+
+def worker(conn, metrics, profiler, name, function, args, hand_back):
+    # Only what this worker records goes back to the parent
+    metrics.reset()
+    try:
+        if profiler.name:
+            result = profiler.call(profiler.name + '-' + name, function, *args)
+        else:
+            result = function(*args)
+    except Exception as e:
+        result = e
+    conn.send((result, hand_back(name) if hand_back else None, metrics.pop()))
+    conn.close()
+
+def run_workers(calls, workers, metrics, profiler, hand_back=None):
+    ''' Each of calls, a (name, function, args) tuple, in its own process, up
+    to workers at once. Uses Process and Pipe, Lambda has no /dev/shm for
+    Pool or Queue.
+
+    Returns a (result, handed_back) pair per call: what function(*args)
+    returned or raised, and what hand_back(name) then returned in the
+    worker, None if the worker exited without a result. What the workers
+    record in metrics is merged into the parent's, and a profiled handler's
+    workers profile their call under its name.
+    '''
+    results = list()
+    for i in range(0, len(calls), workers):
+        running = list()
+        for name, function, args in calls[i:i + workers]:
+            parent_conn, child_conn = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=worker, args=(child_conn, metrics, profiler, name,
+                                                                   function, args, hand_back))
+            process.start()
+            child_conn.close()
+            running.append((process, parent_conn))
+
+        for process, conn in running:
+            try:
+                result, handed_back, state = conn.recv()
+                metrics.merge(state)
+            except EOFError:
+                result, handed_back = Exception("Worker exited without a result"), None
+            process.join()
+            results.append((result, handed_back))
+
+    return results
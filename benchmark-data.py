@@ -0,0 +1,477 @@
+#!/usr/bin/python
+
+import boto3
+import datetime
+import os
+import imp
+import sys
+import json
+import time
+import random
+import gzip
+import shutil
+import StringIO
+import tempfile
+import argparse
+import resource
+import threading
+import subprocess
+import urlparse
+import BaseHTTPServer
+import multiprocessing
+
+try:
+    import moto
+except ImportError:
+    moto = None
+
+# Offline benchmarks of get-data.py, process-data.py and publish-data.py.
+# The Steam API is replaced by a local HTTP server serving synthetic
+# GetMatchHistoryBySequenceNum pages, DynamoDB and S3 by moto. Each run is
+# measured in its own process for its peak RSS. Absolute numbers include the
+# stand-ins' overhead, compare runs with each other: --output records the
+# results as JSON and --compare prints the change from an earlier record.
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+ad_common = imp.load_source('ad_common', os.path.join(PATH, 'ad-common.py'))
+get_data = imp.load_source('get_data', os.path.join(PATH, 'get-data.py'))
+process_data = imp.load_source('process_data', os.path.join(PATH, 'process-data.py'))
+publish_data = imp.load_source('publish_data', os.path.join(PATH, 'publish-data.py'))
+
+BENCHMARKS = ['get', 'write', 'parse', 'process', 'merge', 'rollup']
+SIZES = [1000, 5000]
+
+# Synthetic matches: share of AD matches and of leavers as seen in the real
+# data, a match starting every SEQ_SECONDS from FIRST_START_TIME
+AD_RATIO = 0.3
+LEAVER_RATIO = 0.02
+SEQ_SECONDS = 3
+FIRST_SEQ_NUM = 1000000
+FIRST_START_TIME = 1451606400
+N_HEROES = 110
+N_ITEMS = 250
+N_ABILITIES = 400
+FIRST_ABILITY = 5000
+
+# Days of rollups merged at once by the 'merge' benchmark, and days of parts
+# rolled up into a month by the 'rollup' one
+MERGE_SCALES = {'month': 31, 'quarter': 92}
+ROLLUP_DAYS = 31
+
+log = ad_common.log
+
+def make_player(slot, rnd):
+    player = {
+        'account_id': rnd.randint(1, 1 << 30),
+        'player_slot': slot,
+        'hero_id': rnd.randint(1, N_HEROES),
+        'kills': rnd.randint(0, 20),
+        'deaths': rnd.randint(0, 20),
+        'assists': rnd.randint(0, 30),
+        'leaver_status': 2 if rnd.random() < LEAVER_RATIO else 0,
+    }
+    for i in range(6):
+        player['item_' + str(i)] = rnd.randint(0, N_ITEMS)
+
+    # Four abilities and an ultimate, levelled once a level
+    abilities = rnd.sample(range(FIRST_ABILITY, FIRST_ABILITY + N_ABILITIES), 5)
+    player['ability_upgrades'] = [
+        {'ability': rnd.choice(abilities), 'time': 60 * level, 'level': level}
+        for level in range(1, rnd.randint(10, 25))
+    ]
+    if rnd.random() < 0.05:
+        player['additional_units'] = [{'unitname': 'spirit_bear', 'item_0': rnd.randint(0, N_ITEMS)}]
+    return player
+
+def make_match(seq_num, rnd):
+    ''' Synthetic GetMatchHistoryBySequenceNum match, AD with probability
+    AD_RATIO '''
+    ad = rnd.random() < AD_RATIO
+    slots = range(5) + range(128, 133)
+    return {
+        'match_seq_num': seq_num,
+        'match_id': seq_num * 2,
+        'radiant_win': rnd.random() < 0.5,
+        'duration': rnd.randint(600, 3600),
+        'start_time': FIRST_START_TIME + (seq_num - FIRST_SEQ_NUM) * SEQ_SECONDS,
+        'game_mode': 18 if ad else rnd.choice([1, 2, 22]),
+        'human_players': 10,
+        'lobby_type': 0,
+        'players': [make_player(slot, rnd) for slot in slots],
+    }
+
+def make_page(seq_num, n_matches):
+    ''' Body of a page, the same for the same arguments '''
+    rnd = random.Random(seq_num)
+    matches = [make_match(s, rnd) for s in range(seq_num, seq_num + n_matches)]
+    return json.dumps({'result': {'status': 1, 'matches': matches}})
+
+class ApiStub(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves synthetic pages up to head_seq_num, gzipped when asked to '''
+    protocol_version = 'HTTP/1.1'
+    head_seq_num = FIRST_SEQ_NUM
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        seq_num = int(query['start_at_match_seq_num'][0])
+        n_matches = int(query.get('matches_requested', ['100'])[0])
+        body = make_page(seq_num, max(0, min(n_matches, self.head_seq_num - seq_num)))
+
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fd:
+                fd.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_api_stub():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ApiStub)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/IDOTA2Match_570' % server.server_port
+
+def create_tables():
+    dynamodb = boto3.resource('dynamodb')
+    dynamodb.create_table(
+        TableName='ad-data',
+        KeySchema=[
+            {'AttributeName': 'date', 'KeyType': 'HASH'},
+            {'AttributeName': 'match_seq_num', 'KeyType': 'RANGE'},
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'date', 'AttributeType': 'S'},
+            {'AttributeName': 'match_seq_num', 'AttributeType': 'N'},
+        ],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+    )
+    dynamodb.create_table(
+        TableName='ad-metadata',
+        KeySchema=[{'AttributeName': 'role', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'role', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+    )
+    return dynamodb
+
+def measure_worker(conn, function, args):
+    try:
+        start_time = time.time()
+        result = function(*args)
+        result['seconds'] = time.time() - start_time
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send(result)
+    except Exception as e:
+        conn.send(e)
+    conn.close()
+
+def measure(function, *args):
+    ''' function(*args), a dict, run in its own process, with the seconds it
+    took and the process's peak RSS added. The process sees the stand-ins as
+    they were, what it writes to them is lost. '''
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=measure_worker, args=(child_conn, function, args))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = Exception("Benchmark process exited without a result")
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def run_get():
+    get_data.lambda_handler({'shard_workers': 1})
+
+    # What the run got through, it may stop short of the API head
+    dynamodb = boto3.resource('dynamodb')
+    cursor = dynamodb.Table('ad-metadata').get_item(Key={'role': 'latest_seq_num'})['Item']
+    ad_matches = 0
+    params = {'Select': 'COUNT'}
+    while True:
+        response = dynamodb.Table('ad-data').scan(**params)
+        ad_matches += response['Count']
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return {
+        'matches': int(cursor['match_seq_num']) - FIRST_SEQ_NUM,
+        'ad_matches': ad_matches,
+    }
+
+def bench_get(size):
+    ''' get-data.py from FIRST_SEQ_NUM until the API runs out, size matches
+    later '''
+    get_data.API_URL = start_api_stub()
+    get_data.TIMEOUT = 3600
+    ApiStub.head_seq_num = FIRST_SEQ_NUM + size
+
+    metadata_table = create_tables().Table('ad-metadata')
+    metadata_table.put_item(Item={'role': 'latest_seq_num', 'match_seq_num': FIRST_SEQ_NUM, 'end_time': 0})
+    metadata_table.put_item(Item={'role': 'dota_api_key', 'dota_api_keys': ['key%d' % i for i in range(4)]})
+
+    result = measure(run_get)
+    result['matches_per_sec'] = result['matches'] / result['seconds']
+    return result
+
+def make_items(size):
+    ''' size accepted matches as get-data.py stores them in ad-data '''
+    rnd = random.Random(size)
+    encode_match = get_data.MATCH_ENCODINGS[get_data.MATCH_ENCODING]
+    items = list()
+    seq_num = FIRST_SEQ_NUM
+    while len(items) < size:
+        match = make_match(seq_num, rnd)
+        seq_num += 1
+        if get_data.accept_match(match):
+            items.append(encode_match(match))
+    return items
+
+def run_write(items, batched):
+    dynamodb = boto3.resource('dynamodb')
+    if batched:
+        writer = get_data.BatchWriter(dynamodb, 'ad-data')
+        for item in items:
+            writer.put(item)
+        writer.flush()
+    else:
+        data_table = dynamodb.Table('ad-data')
+        for item in items:
+            data_table.put_item(Item=item)
+    return {'matches': len(items)}
+
+def bench_write(size):
+    ''' size matches written to ad-data with get-data.py's BatchWriter and
+    with a put_item each '''
+    create_tables()
+    items = make_items(size)
+    results = dict()
+    for name, batched in [('batch', True), ('put_item', False)]:
+        result = measure(run_write, items, batched)
+        result['matches_per_sec'] = result['matches'] / result['seconds']
+        results[name] = result
+    return results
+
+def run_parse(pages, streamed):
+    n_matches = 0
+    n_accepted = 0
+    for body in pages:
+        if streamed:
+            page = get_data.parse_page(body)
+            n_matches += page['n_matches']
+            n_accepted += len(page['matches'])
+        else:
+            matches = json.loads(body)['result']['matches']
+            n_matches += len(matches)
+            n_accepted += len([match for match in matches if get_data.accept_match(match)])
+    return {'matches': n_matches, 'accepted': n_accepted}
+
+def bench_parse(size):
+    ''' size matches in API pages parsed with get-data.py's parse_page and
+    with json.loads, filtered by accept_match '''
+    pages = [make_page(seq_num, min(get_data.API_PAGE_SIZE, FIRST_SEQ_NUM + size - seq_num))
+             for seq_num in range(FIRST_SEQ_NUM, FIRST_SEQ_NUM + size, get_data.API_PAGE_SIZE)]
+    results = dict()
+    for name, streamed in [('parse_page', True), ('json_loads', False)]:
+        result = measure(run_parse, pages, streamed)
+        result['matches_per_sec'] = result['matches'] / result['seconds']
+        results[name] = result
+    return results
+
+def flat_projection():
+    # moto doesn't evaluate list index paths such as #p[0].#a0, fetch the
+    # whole players attribute instead
+    names = {'#p': 'players'}
+    for i, attribute in enumerate(process_data.MATCH_ATTRIBUTES):
+        names['#m' + str(i)] = attribute
+    return ', '.join(sorted(names)), names
+
+def run_process(date, bucket):
+    deadline = process_data.Deadline(None, time.time(), 3600)
+    options = {
+        'aggregator': process_data.AGGREGATOR,
+        'page_size': process_data.QUERY_PAGE_SIZE,
+        'part_format': process_data.PART_FORMAT,
+    }
+    result = process_data.process_date(date, 0, deadline, bucket, options)
+    return {'capacity': result['capacity']}
+
+def bench_process(size):
+    ''' process-data.py on a day of size accepted matches '''
+    process_data.match_projection = flat_projection
+    date = datetime.date.fromtimestamp(FIRST_START_TIME)
+
+    data_table = create_tables().Table('ad-data')
+    boto3.client('s3').create_bucket(Bucket='ad-processed')
+
+    rnd = random.Random(size)
+    encode_match = get_data.MATCH_ENCODINGS[get_data.MATCH_ENCODING]
+    seq_num = FIRST_SEQ_NUM
+    with data_table.batch_writer() as writer:
+        for _ in range(size):
+            match = make_match(seq_num, rnd)
+            seq_num += 1
+            match['game_mode'] = 18
+            for player in match['players']:
+                player['leaver_status'] = 0
+            get_data.accept_match(match)
+            match['date'] = str(date)
+            writer.put_item(Item=encode_match(match))
+
+    result = measure(run_process, date, 'ad-processed')
+    result['matches'] = size
+    result['matches_per_sec'] = size / result['seconds']
+    return result
+
+def make_table(n_keys, rnd):
+    ''' {total, wins} table of n_keys (ability, item) keys '''
+    table = {'total': dict(), 'wins': dict()}
+    while len(table['total']) < n_keys:
+        key = publish_data.pack_key(rnd.randint(FIRST_ABILITY, FIRST_ABILITY + 10 * N_ABILITIES),
+                                    rnd.randint(0, 10 * N_ITEMS))
+        total = rnd.randint(1, 100)
+        table['total'][key] = total
+        table['wins'][key] = rnd.randint(0, total)
+    return table
+
+def run_merge(filenames, out_file, out_format, mode):
+    publish_data.MERGE_MODE = mode
+    publish_data.merge_csv(filenames, out_file, out_format)
+    return {'out_bytes': os.path.getsize(out_file)}
+
+def bench_merge(size):
+    ''' merge_csv of the rollups of size keys of each of MERGE_SCALES, for
+    each format, streamed and in memory '''
+    rnd = random.Random(size)
+    results = dict()
+    for scale, n_files in sorted(MERGE_SCALES.items()):
+        for out_format in sorted(publish_data.ROW_WRITERS):
+            temp_dir = tempfile.mkdtemp()
+            filenames = list()
+            for i in range(n_files):
+                filename = temp_dir + '/%d%s' % (i, publish_data.FORMAT_EXTENSIONS[out_format])
+                writer = publish_data.write_csv if out_format == 'csv' else publish_data.write_packed
+                writer(make_table(size, rnd), filename, header=publish_data.TABLES['item']['csv_header'])
+                filenames.append(filename)
+            in_bytes = sum(os.path.getsize(filename) for filename in filenames)
+
+            for mode in ['stream', 'memory']:
+                result = measure(run_merge, filenames, temp_dir + '/out', out_format, mode)
+                result['rows'] = n_files * size
+                result['in_bytes'] = in_bytes
+                result['rows_per_sec'] = result['rows'] / result['seconds']
+                result['mb_per_sec'] = result['in_bytes'] / result['seconds'] / (1 << 20)
+                results.setdefault(scale, dict()).setdefault(mode, dict())[out_format] = result
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def run_rollup(node, bucket):
+    temp_dir = tempfile.mkdtemp()
+    cache = publish_data.ObjectCache(temp_dir + '/cache', publish_data.CACHE_BYTES)
+    fetcher = publish_data.S3Fetcher(temp_dir, publish_data.S3_CONCURRENCY, cache)
+    try:
+        publish_data.prefetch_data('item', node[0], publish_data.node_end(node), bucket, fetcher)
+        filename = publish_data.get_node('item', node, bucket, fetcher)
+        return {'out_bytes': os.path.getsize(filename)}
+    finally:
+        fetcher.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def bench_rollup(size):
+    ''' A month rollup from ROLLUP_DAYS days of parts of size keys in S3,
+    the day and week rollups included '''
+    s3_client = boto3.client('s3')
+    s3_client.create_bucket(Bucket='ad-processed')
+
+    rnd = random.Random(size)
+    temp_dir = tempfile.mkdtemp()
+    date = datetime.date.fromtimestamp(FIRST_START_TIME)
+    for day in range(ROLLUP_DAYS):
+        filename = temp_dir + '/part'
+        process_data.write_csv(make_table(size, rnd), process_data.TABLES['item']['csv_header'], filename)
+        s3_key = str(date + datetime.timedelta(days=day)) + '/item.part0-1.csv'
+        s3_client.upload_file(filename, 'ad-processed', s3_key)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+    result = measure(run_rollup, (date, 'month'), 'ad-processed')
+    result['rows'] = ROLLUP_DAYS * size
+    result['rows_per_sec'] = result['rows'] / result['seconds']
+    return result
+
+def run_benchmark(name, size):
+    function = globals()['bench_' + name]
+    if name in ['parse', 'merge']:
+        return function(size)
+    if not moto:
+        raise Exception("moto is needed for the " + name + " benchmark")
+
+    # Fresh stand-ins for each run
+    with moto.mock_dynamodb2(), moto.mock_s3():
+        return function(size)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PATH).strip()
+    except Exception:
+        return None
+
+def compare(results, previous):
+    ''' Log the change of each per second metric from previous results '''
+    def rates(results, prefix=''):
+        for name, value in sorted(results.items()):
+            if isinstance(value, dict):
+                for item in rates(value, prefix + name + '/'):
+                    yield item
+            elif name.endswith('_per_sec'):
+                yield prefix + name, value
+
+    before = dict(rates(previous['results']))
+    for name, value in rates(results['results']):
+        if name in before:
+            log('%s %.1f -> %.1f (%+.1f%%)' % (name, before[name], value, 100.0 * (value / before[name] - 1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the ingest, process and publish functions")
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+                        help="some of " + ", ".join(BENCHMARKS) + ", all of them by default")
+    parser.add_argument('--sizes', type=lambda value: map(int, value.split(',')), default=SIZES,
+                        help="matches for get, write, parse and process, keys per file for merge and rollup")
+    parser.add_argument('--output', help="JSON file to record the results in")
+    parser.add_argument('--compare', help="JSON file of earlier results to compare with")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark " + name)
+
+    # moto takes any credentials, but boto3 wants some
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': sys.version.split()[0],
+        'results': dict(),
+    }
+    for name in args.benchmarks:
+        for size in args.sizes:
+            log('Running ' + name + ' ' + str(size))
+            result = run_benchmark(name, size)
+            results['results'].setdefault(name, dict())[str(size)] = result
+            log(json.dumps(result, sort_keys=True))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd))
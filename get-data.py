@@ -1,162 +1,784 @@
 #!/usr/bin/python
 
 import boto3
+import botocore
+from boto3.dynamodb.conditions import Attr
 import json
 import time
-import urllib2
 import datetime
-from itertools import cycle
+import threading
+import Queue
+import httplib
+import socket
+import urllib
+import urlparse
+import zlib
+import re
+import os
+import imp
+import struct
+import tempfile
+import shutil
+
+# Metrics, profiling and Deadline, shared with the other functions
+ad_common = imp.load_source('ad_common', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ad-common.py'))
 
 API_URL = "https://api.steampowered.com/IDOTA2Match_570"
+# Seconds to run for when there is no Lambda context to take the deadline from
 TIMEOUT = 290
-EARLY_TIMEOUT = TIMEOUT - 0
 
-def log(message):
-    print datetime.datetime.now().isoformat() + ' | ' + str(message)
+# Seconds kept back from the Lambda deadline for the metadata update, and the
+# assumed seconds a unit of work takes until one has been measured. The
+# final flush is budgeted as an 'upload' unit.
+DEADLINE_RESERVE = 5
+UNIT_COSTS = {
+    'api_page': 5.0,
+    'dynamodb_page': 2.0,
+    'upload': 10.0,
+}
 
-def lambda_handler(event={}, context={}):
-    start_time = time.time()
+# Seconds to wait on connect and on each socket read
+API_TIMEOUT = 30
+# Matches requested per page, fewer when only part of a page's time is left
+API_PAGE_SIZE = 1000
+API_MIN_PAGE_SIZE = 20
+API_MAX_IDLE = 4
+# Responses worth retrying, possibly with another key
+API_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+API_THROTTLE_STATUS = (429, 503)
+
+# BatchWriteItem accepts at most 25 puts per request
+BATCH_SIZE = 25
+BATCH_BUFFER = 100
+BATCH_BACKOFF = 0.05
+BATCH_MAX_BACKOFF = 5
+BATCH_MAX_RETRIES = 10
+
+# How matches are stored in ad-data: 'full' keeps the API match as is,
+# 'compact' keeps only what process-data.py reads (see compact_match)
+MATCH_ENCODING = 'compact'
+
+# Pages fetched ahead of the writer
+PIPELINE_DEPTH = 2
+
+# Fused mode aggregates accepted matches with process-data.py's code and
+# uploads its part files at the end of the run, instead of process-data.py
+# reading them back from ad-data. ad-data is then only written if
+# FUSED_ARCHIVE is set. process-data.py must be deployed next to this file.
+FUSED = False
+FUSED_ARCHIVE = True
+PROCESS_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process-data.py')
+
+# S3 bucket to archive the raw API pages in for replay-data.py, None to not
+# archive them. A run's pages go in one segment, RAW_MAGIC followed by a zlib
+# stream of records: the page's first seq num and body length as '<QI', then
+# the body. Segments are stored as raw/<date>/<first seq num>-<next seq num>.seg,
+# date being the one of the first page's last match.
+RAW_ARCHIVE = None
+RAW_MAGIC = 'ADR1'
+
+# With SHARD_WORKERS above 1, when more than SHARD_BEHIND seconds behind,
+# the backlog is split into shards of SHARD_SEQ_NUMS seq nums, recorded as
+# 'shard-<start>' rows in ad-metadata and leased to up to SHARD_WORKERS
+# concurrent invocations, each with its own slot of the API keys. Workers are
+# started with lambda:InvokeFunction, or worked inline if that fails.
+# latest_seq_num advances over the contiguous finished shards and into the
+# first unfinished one. No shards are added past the API head once a worker
+# has reached it.
+SHARD_BEHIND = 6*60*60
+SHARD_SEQ_NUMS = 100000
+SHARD_WORKERS = 1
+# Seconds a lease outlives its worker's deadline
+LEASE_MARGIN = DEADLINE_RESERVE + 60
+
+# Per-key request rate (requests/second) and burst allowed by the API
+KEY_RATE = 1.0
+KEY_BURST = 1
+KEY_MAX_BACKOFF = 30
+# Weight of the latest call in the per-key error/latency averages
+KEY_DECAY = 0.2
+
+log = ad_common.log
+
+# Shared by the whole invocation
+metrics = ad_common.Metrics('get-data')
+profiler = ad_common.Profiler('get-data')
+
+class BatchWriter(object):
+    ''' Buffers items for a table and writes them with BatchWriteItem.
+
+    At most buffer_size items are held before they are written out. Items
+    returned as UnprocessedItems are resent with exponential backoff. Call
+    flush() before checkpointing anything that depends on the items having
+    been written.
+    '''
+    def __init__(self, dynamodb, table_name, buffer_size=BATCH_BUFFER):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.buffer_size = buffer_size
+        self.buffer = list()
+        self.written = 0
+
+    def put(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        while self.buffer:
+            batch = self.buffer[:BATCH_SIZE]
+            self.write_batch(batch)
+            del self.buffer[:BATCH_SIZE]
+            self.written += len(batch)
+
+    def write_batch(self, items):
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        backoff = BATCH_BACKOFF
+        retries = 0
+
+        while requests:
+            response = self.dynamodb.batch_write_item(
+                RequestItems={
+                    self.table_name: requests
+                },
+                ReturnConsumedCapacity='TOTAL',
+            )
+            for capacity in response.get('ConsumedCapacity', []):
+                metrics.count('DynamoDbWriteCapacity', capacity.get('CapacityUnits', 0))
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                break
+            metrics.count('DynamoDbUnprocessedItems', len(requests))
+
+            retries += 1
+            if retries > BATCH_MAX_RETRIES:
+                raise Exception(str(len(requests)) + " items still unprocessed after " +
+                                str(BATCH_MAX_RETRIES) + " retries")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BATCH_MAX_BACKOFF)
+
+class ApiError(Exception):
+    ''' Failed API request, classified for the retry logic '''
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+        # Anything but a clear refusal is worth another try
+        self.retryable = status is None or status in API_RETRY_STATUS
+        self.throttled = status in API_THROTTLE_STATUS
+
+class ApiClient(object):
+    ''' Steam Web API client keeping connections alive per host.
+
+    Idle connections are pooled by (scheme, host) and kept on the module
+    level client, so warm Lambda invocations skip the TCP/TLS handshake.
+    Responses are requested gzip compressed.
+    '''
+    def __init__(self, timeout=API_TIMEOUT, max_idle=API_MAX_IDLE):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.pool = dict()
+        self.lock = threading.Lock()
+
+    def checkout(self, scheme, host):
+        with self.lock:
+            idle = self.pool.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def checkin(self, scheme, host, conn):
+        with self.lock:
+            idle = self.pool.setdefault((scheme, host), list())
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def get(self, url, params):
+        ''' Body of GET url?params, raises ApiError '''
+        parts = urlparse.urlsplit(url)
+        path = parts.path + '?' + urllib.urlencode(params)
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+
+        while True:
+            conn, reused = self.checkout(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # Pooled connections may have been dropped while idle
+                if not reused:
+                    raise ApiError(repr(e))
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(parts.scheme, parts.netloc, conn)
+
+        if response.status != 200:
+            raise ApiError('HTTP ' + str(response.status), response.status)
+
+        if response.getheader('content-encoding', '') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def get_match_history_by_seq_num(self, key, seq_num, matches_requested=1000):
+        return self.get(API_URL + '/GetMatchHistoryBySequenceNum/V001/', [
+            ('key', key),
+            ('start_at_match_seq_num', seq_num),
+            ('matches_requested', matches_requested),
+        ])
+
+# Shared by warm invocations
+api_client = ApiClient()
+
+class KeyScheduler(object):
+    ''' Hands out API keys according to their rate limits and health.
+
+    Every key has a token bucket refilled at KEY_RATE and its own backoff
+    after failures, so a throttled or broken key only delays itself.
+    acquire() picks the ready key with the lowest recent error/throttle
+    rate, then latency, and sleeps exactly until the next key becomes
+    eligible when none are ready.
+    '''
+    def __init__(self, keys, rate=KEY_RATE, burst=KEY_BURST):
+        now = time.time()
+        self.rate = float(rate)
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.keys = dict()
+        for index, key in enumerate(keys):
+            self.keys[key] = {
+                # Stands for the key in metrics
+                'index': index,
+                'tokens': float(burst),
+                'refilled': now,
+                'blocked_until': 0,
+                'backoff': 0,
+                'errors': 0.0,
+                'throttles': 0.0,
+                'latency': 0.0,
+            }
+
+    def ready_at(self, state, now):
+        tokens = min(self.burst, state['tokens'] + (now - state['refilled']) * self.rate)
+        state['tokens'] = tokens
+        state['refilled'] = now
+        token_at = now if tokens >= 1 else now + (1 - tokens) / self.rate
+        return max(token_at, state['blocked_until'])
+
+    def acquire(self, deadline, stop_event=None):
+        ''' Take a request token from the best ready key, None past deadline '''
+        while True:
+            with self.lock:
+                now = time.time()
+                best = None
+                next_ready = None
+                for key, state in self.keys.iteritems():
+                    ready = self.ready_at(state, now)
+                    if ready <= now:
+                        health = (state['errors'] + state['throttles'], state['latency'])
+                        if best is None or health < best[0]:
+                            best = (health, key)
+                    elif next_ready is None or ready < next_ready:
+                        next_ready = ready
+
+                if best:
+                    self.keys[best[1]]['tokens'] -= 1
+                    return best[1]
+
+            if stop_event is not None and stop_event.is_set():
+                return None
+            if next_ready is None or next_ready > deadline:
+                return None
+
+            if stop_event is not None:
+                stop_event.wait(next_ready - now)
+            else:
+                time.sleep(next_ready - now)
+
+    def report(self, key, latency, ok, throttled=False, refused=False):
+        ''' Record the outcome of a request made with key '''
+        with self.lock:
+            state = self.keys[key]
+            state['errors'] += KEY_DECAY * ((0.0 if ok or throttled else 1.0) - state['errors'])
+            state['throttles'] += KEY_DECAY * ((1.0 if throttled else 0.0) - state['throttles'])
+            if ok:
+                state['latency'] += KEY_DECAY * (latency - state['latency'])
+                state['backoff'] = 0
+            else:
+                state['backoff'] = min(max(state['backoff'] * 2, 1), KEY_MAX_BACKOFF)
+                if refused:
+                    state['backoff'] = KEY_MAX_BACKOFF
+                state['blocked_until'] = time.time() + state['backoff']
+
+# Shared by warm invocations
+unit_costs = dict()
+
+class Deadline(ad_common.Deadline):
+    ''' ad_common.Deadline with DEADLINE_RESERVE and UNIT_COSTS '''
+    def __init__(self, context, start_time, timeout, costs=unit_costs):
+        super(Deadline, self).__init__(context, start_time, timeout, DEADLINE_RESERVE, UNIT_COSTS, costs)
+
+def fetch_page(seq_num, scheduler, deadline, stop_event, keep_body=False):
+    ''' Parsed GetMatchHistoryBySequenceNum page at seq_num, None on timeout.
+    With keep_body the raw response is kept as page['body']. '''
+    # Retry until success or timeout
+    while True:
+        dota_api_key = scheduler.acquire(deadline.end, stop_event)
+        if dota_api_key is None:
+            return None
+
+        matches_requested = deadline.size('api_page', API_PAGE_SIZE)
+        if matches_requested < API_MIN_PAGE_SIZE:
+            return None
+
+        api_call_time = time.time()
+        status = 0
+        error = None
+        try:
+            body = api_client.get_match_history_by_seq_num(dota_api_key, seq_num, matches_requested)
+            page = parse_page(body)
+            if keep_body:
+                page['body'] = body
+            status = page['status']
+        except ApiError as e:
+            error = e
+        except Exception:
+            # log("Try next API key at seq num " + str(seq_num))
+            pass
+
+        latency = time.time() - api_call_time
+        scheduler.report(dota_api_key, latency, status == 1,
+                         throttled=bool(error and error.throttled),
+                         refused=bool(error and not error.retryable))
+        metrics.time('ApiLatency', latency)
+        metrics.time('ApiLatencyKey%d' % scheduler.keys[dota_api_key]['index'], latency)
+        if status != 1:
+            metrics.count('ApiRetries')
+        if error and error.throttled:
+            metrics.count('ApiThrottles')
+
+        if status == 1:
+            deadline.record('api_page', latency * API_PAGE_SIZE / matches_requested)
+            return page
+
+        # log("GetMatchHistoryBySequenceNum failed at seq num " + str(seq_num))
+        if deadline.remaining() <= 0:
+            # log("Early timeout")
+            return None
+
+def accept_match(match):
+    ''' True for AD matches worth keeping, sets their date '''
+    # Filter out bad games
+    if match['game_mode'] != 18:
+        return False
+    if match['human_players'] != 10:
+        return False
+    if match['start_time'] == 0:
+        return False
+    if match['duration'] < 900:
+        return False
+    for player in match['players']:
+        if player['leaver_status'] >= 2:
+            return False
+    for player in match['players']:
+        # Remove additonal_units, it only causes problems
+        player.pop('additional_units', None)
+
+    # Set date
+    end_time = match['start_time'] + match['duration']
+    date = datetime.date.fromtimestamp(end_time).isoformat()
+    match['date'] = date
+
+    return True
+
+def compact_match(match):
+    ''' Projection of an accepted match holding only what process-data.py reads
+
+    Players become {'h': hero_id, 's': player_slot, 'i': [item_0..item_5],
+    'a': [distinct abilities]}, 'a' being left out when the player has no
+    ability_upgrades.
+    '''
+    try:
+        radiant_win = (match['match_outcome'] == 2)
+    except KeyError:
+        radiant_win = match['radiant_win']
+
+    players = list()
+    for player in match['players']:
+        compact = {
+            'h': player['hero_id'],
+            's': player['player_slot'],
+            'i': [player['item_%s' % item] for item in range(0, 6)],
+        }
+        if 'ability_upgrades' in player:
+            compact['a'] = sorted(set(upgrade['ability'] for upgrade in player['ability_upgrades']))
+        players.append(compact)
+
+    return {
+        'date': match['date'],
+        'match_seq_num': match['match_seq_num'],
+        'encoding': 'compact',
+        'radiant_win': radiant_win,
+        'start_time': match['start_time'],
+        'duration': match['duration'],
+        'players': players,
+    }
+
+MATCH_ENCODINGS = {
+    'full': lambda match: match,
+    'compact': compact_match,
+}
+
+json_decoder = json.JSONDecoder()
+json_whitespace = re.compile(r'[ \t\n\r]*')
+json_status = re.compile(r'"status"\s*:\s*(-?\d+)')
+
+def iter_matches(body, pos):
+    ''' Decode the match array starting at body[pos] one match at a time '''
+    pos = json_whitespace.match(body, pos + 1).end()
+    if body[pos] == ']':
+        return
+    while True:
+        match, pos = json_decoder.raw_decode(body, pos)
+        yield match
+        pos = json_whitespace.match(body, pos).end()
+        if body[pos] == ']':
+            return
+        # skip ','
+        pos = json_whitespace.match(body, pos + 1).end()
+
+def parse_page(body):
+    ''' Status and accepted matches of a GetMatchHistoryBySequenceNum body
+
+    Matches are decoded and filtered one at a time, so rejected ones are
+    dropped right away instead of being held for the whole page.
+    '''
+    page = {
+        'status': 0,
+        'n_matches': 0,
+        'matches': list(),
+    }
+
+    key_pos = body.find('"matches"')
+    status = json_status.search(body, 0, max(key_pos, 0))
+    if key_pos < 0 or not status:
+        # Unexpected layout, fall back to decoding it all
+        result = json.loads(body)['result']
+        page['status'] = result['status']
+        matches = result.get('matches', list())
+    else:
+        page['status'] = int(status.group(1))
+        matches = iter_matches(body, body.index('[', key_pos))
+
+    last = None
+    for match in matches:
+        page['n_matches'] += 1
+        last = match
+        if accept_match(match):
+            page['matches'].append(match)
+
+    if last:
+        page['next_seq_num'] = last['match_seq_num'] + 1
+        page['start_time'] = last['start_time']
+        page['end_time'] = last['start_time'] + last['duration']
+
+    return page
+
+# process-data.py, loaded by the first fused run and kept by warm invocations
+process_data = None
+
+def load_process_data():
+    ''' process-data.py as a module of its own name, so that loading it
+    doesn't re-run a process_data module loaded next to this one '''
+    global process_data
+    if process_data is None:
+        process_data = imp.load_source('ad_process_data', PROCESS_DATA)
+    return process_data
+
+class FusedAggregator(object):
+    ''' process-data.py's aggregation of the matches of a run, by date
+
+    Matches are decoded from their ad-data encoding, so the part files are
+    the same as process-data.py would write after reading them back.
+    '''
+    def __init__(self, seq_num, aggregator=None, part_format=None):
+        self.process_data = load_process_data()
+        self.seq_num = seq_num
+        self.aggregator = aggregator or self.process_data.AGGREGATOR
+        self.part_format = part_format or self.process_data.PART_FORMAT
+        self.aggregators = dict()
+
+    def add_page(self, items):
+        ''' Aggregate the encoded matches of a written page '''
+        matches = dict()
+        for item in items:
+            matches.setdefault(item['date'], list()).append(self.process_data.decode_match(item))
+
+        for date in matches:
+            if date not in self.aggregators:
+                self.aggregators[date] = self.process_data.AGGREGATORS[self.aggregator]()
+            self.aggregators[date].add_matches(matches[date])
+
+    def upload(self, seq_num, bucket):
+        ''' Upload the part files of each date for the matches after the
+        run's first seq num up to seq_num '''
+        for date in sorted(self.aggregators):
+            self.process_data.upload_parts(
+                self.aggregators[date],
+                datetime.datetime.strptime(date, '%Y-%m-%d').date(),
+                self.seq_num, seq_num, bucket, self.part_format)
+        metrics.merge(self.process_data.metrics.pop())
+
+class RawArchive(object):
+    ''' Segment of the raw pages of a run, see RAW_ARCHIVE. The segment file
+    is only created with the first page; close() removes it. '''
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.temp_dir = None
+        self.fd = None
+        self.compressor = zlib.compressobj()
+        self.first_seq_num = None
+        self.date = None
+
+    def add(self, seq_num, page):
+        seq_num = int(seq_num)
+        if self.first_seq_num is None:
+            self.temp_dir = tempfile.mkdtemp()
+            self.filename = self.temp_dir + '/segment'
+            self.fd = open(self.filename, 'wb')
+            self.fd.write(RAW_MAGIC)
+            self.first_seq_num = seq_num
+            self.date = datetime.date.fromtimestamp(page['end_time']).isoformat()
+        self.fd.write(self.compressor.compress(struct.pack('<QI', seq_num, len(page['body']))))
+        self.fd.write(self.compressor.compress(page['body']))
+
+    def upload(self, next_seq_num):
+        ''' Upload the segment, its pages ending before next_seq_num '''
+        self.fd.write(self.compressor.flush())
+        self.fd.close()
+
+        s3_key = 'raw/%s/%020d-%020d.seg' % (self.date, self.first_seq_num, int(next_seq_num))
+        log('uploading ' + self.bucket + '/' + s3_key)
+        boto3.client('s3').upload_file(self.filename, self.bucket, s3_key)
+        metrics.count('BytesUploaded', os.path.getsize(self.filename), 'Bytes')
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class PageFetcher(threading.Thread):
+    ''' Fetches and filters pages ahead of the writer.
+
+    The next page starts at the last match_seq_num of the current one, so
+    it can be requested while the current page is still being written.
+    Pages go on a bounded queue as ('page', page); the last entry is
+    ('done', reason) once the fetcher stops.
+    '''
+    def __init__(self, seq_num, dota_api_keys, deadline, depth=PIPELINE_DEPTH, keep_body=False,
+                 end_seq_num=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.keep_body = keep_body
+        self.seq_num = seq_num
+        self.end_seq_num = end_seq_num
+        self.scheduler = KeyScheduler(dota_api_keys)
+        self.deadline = deadline
+        self.at_head = False
+        self.pages = Queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def send(self, message):
+        # Don't block forever on a writer that has given up
+        while not self.stop_event.is_set():
+            try:
+                self.pages.put(message, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            if profiler.name:
+                reason = profiler.call(profiler.name + '-fetcher', self.fetch_pages)
+            else:
+                reason = self.fetch_pages()
+        except Exception as e:
+            reason = e
+        self.send(('done', reason))
+
+    def fetch_pages(self):
+        while not self.stop_event.is_set():
+            if self.end_seq_num is not None and self.seq_num >= self.end_seq_num:
+                return "Reached end of shard"
+
+            page = fetch_page(self.seq_num, self.scheduler, self.deadline, self.stop_event,
+                              self.keep_body)
+            if page is None:
+                return "Time's up"
+
+            if page['n_matches'] < 20:
+                self.at_head = True
+                return "Less than 20 matches available"
+
+            # Matches past the end belong to the next shard
+            if self.end_seq_num is not None and page['next_seq_num'] > self.end_seq_num:
+                page['matches'] = [match for match in page['matches']
+                                   if match['match_seq_num'] < self.end_seq_num]
+                page['next_seq_num'] = self.end_seq_num
+                if page['matches']:
+                    last = page['matches'][-1]
+                    page['start_time'] = last['start_time']
+                    page['end_time'] = last['start_time'] + last['duration']
+
+            self.seq_num = page['next_seq_num']
+
+            if not self.send(('page', page)):
+                break
+
+        return "Stopped"
+
+def ingest(latest_seq_num, latest_end_time, dota_api_keys, deadline, event, end_seq_num=None):
+    ''' Fetch, filter and store matches from latest_seq_num until the
+    deadline, or until end_seq_num if given
+
+    Returns the seq num and end time reached, whether that is the API head
+    and the exception that stopped ingestion, if any. Everything before the
+    seq num reached is written.
+    '''
     ex = None
+    at_head = False
 
     dynamodb = boto3.resource('dynamodb')
-    data_table = dynamodb.Table('ad-data')
+    data_writer = BatchWriter(dynamodb, 'ad-data')
     metadata_table = dynamodb.Table('ad-metadata')
-    response = metadata_table.get_item(
-        Key={
-            'role': 'latest_seq_num'
-        }
-    )
-    latest_seq_num = response['Item']['match_seq_num']
-    latest_date = response['Item'].get('date', "")
-    latest_end_time = response['Item'].get('end_time', 0)
 
-    response = metadata_table.get_item(
-        Key={
-            'role': 'dota_api_key'
-        }
-    )
-    # dota_api_key = response['Item']['dota_api_key']
-    dota_api_keys = response['Item']['dota_api_keys']
-    key_iter = cycle(dota_api_keys)
+    encode_match = MATCH_ENCODINGS[event.get('match_encoding', MATCH_ENCODING)]
 
-    timediff=start_time-float(latest_end_time)
-    log("Starting at seq num " + str(latest_seq_num) + ", behind " + str(datetime.timedelta(seconds=timediff)))
+    fused = event.get('fused', FUSED)
+    archive = not fused or event.get('archive', FUSED_ARCHIVE)
+    if fused:
+        response = metadata_table.get_item(
+            Key={
+                'role': 'processed'
+            }
+        )
+        processed_bucket = response['Item']['s3bucket']
+        first_seq_num = latest_seq_num
+        aggregator = FusedAggregator(latest_seq_num - 1, event.get('aggregator'), event.get('part_format'))
 
     total_matches = 0
     total_ad_matches = 0
 
-    while 1:
-        api_call_time = 0
-        backoff = 1
-        status = 0
-        timed_out = False
+    raw_bucket = event.get('raw_archive', RAW_ARCHIVE)
+    raw_archive = RawArchive(raw_bucket) if raw_bucket else None
 
-        # Retry until success or timeout
-        while status != 1:
-            api_elapsed = time.time() - api_call_time
+    fetcher = PageFetcher(latest_seq_num, dota_api_keys, deadline, keep_body=bool(raw_archive),
+                          end_seq_num=end_seq_num)
+    fetcher.start()
+    ingest_start_time = time.time()
+    n_pages = 0
 
-            # Exit if we've hit timeout
-            if time.time() - start_time > TIMEOUT:
-                timed_out = True
-                break
+    try:
+        while 1:
+            kind, page = fetcher.pages.get()
 
-            while api_elapsed < backoff:
-                api_elapsed = time.time() - api_call_time
-                time.sleep(1)
+            if kind == 'done':
+                if isinstance(page, Exception):
+                    ex = page
+                else:
+                    log(page)
+                    at_head = fetcher.at_head
+                break
 
-                # Exit if we've hit timeout
-                if time.time() - start_time > TIMEOUT:
-                    timed_out = True
-                    break
-            if timed_out:
+            # Leave pages fetched in the last moments for the next run, keeping
+            # time for the final upload
+            if not deadline.fits('dynamodb_page', ('upload', int(fused) + int(bool(raw_archive)))):
+                log("Time's up")
                 break
 
-            for _ in range(len(dota_api_keys)):
-                dota_api_key = next(key_iter)
-                url = (API_URL + "/GetMatchHistoryBySequenceNum/V001/?key=" + dota_api_key +
-                       "&start_at_match_seq_num=" + str(latest_seq_num) + "&matches_requested=1000")
+            page_start_time = time.time()
+            total_matches += page['n_matches']
 
+            items = list()
+            for match in page['matches']:
+                # queue match for the dynamodb table
                 try:
-                    doc = json.loads(urllib2.urlopen(url).read())
-                    status = doc['result']['status']
-                    if status == 1:
-                        break
-                except Exception:
-                    # log("Try next API key at seq num " + str(latest_seq_num))
-                    pass
-
-            api_call_time = time.time()
-
-            if status == 1:
-                # log("GetMatchHistoryBySequenceNum success at seq num " + str(latest_seq_num))
-                pass
-            else:
-                # log("GetMatchHistoryBySequenceNum failed at seq num " + str(latest_seq_num))
-                if time.time() - start_time > EARLY_TIMEOUT:
-                    # log("Early timeout")
-                    timed_out = True
+                    items.append(encode_match(match))
+                    if archive:
+                        data_writer.put(items[-1])
+                except Exception as e:
+                    log(match)
+                    ex = e
                     break
 
-            backoff *= 2
-            if backoff > 30:
-                backoff = 30
+            # Everything from this page must be written before moving past it
+            if not ex:
+                try:
+                    data_writer.flush()
+                    if fused:
+                        aggregator.add_page(items)
+                except Exception as e:
+                    ex = e
 
-        if timed_out:
-            log("Time's up")
-            break
+            if ex:
+                break
 
-        matches = doc['result']['matches']
-        n_matches = len(matches)
-        total_matches += n_matches
+            total_ad_matches += len(items)
+            n_pages += 1
+            deadline.record('dynamodb_page', time.time() - page_start_time)
+            metrics.time('PageWriteTime', time.time() - page_start_time)
 
-        if n_matches < 20:
-            log("Less than 20 matches available")
-            break
+            if raw_archive:
+                raw_archive.add(latest_seq_num, page)
 
-        for match in matches:
-            # Filter out bad games
-            if match['game_mode'] != 18:
-                continue
-            if match['human_players'] != 10:
-                continue
-            if match['start_time'] == 0:
-                continue
-            if match['duration'] < 900:
-                continue
-            leaver = False
-            for player in match['players']:
-                if player['leaver_status'] >= 2:
-                    leaver = True
-                    break
-                # Remove additonal_units, it only causes problems
-                player.pop('additional_units', None)
-            if leaver:
-                continue
+            latest_seq_num = page['next_seq_num']
+            # start_time is sometimes 0, skip the update if that is the case
+            if page['start_time'] > 0:
+                latest_end_time = page['end_time']
 
-            # Set date
-            end_time = match['start_time'] + match['duration']
-            date = datetime.date.fromtimestamp(end_time).isoformat()
-            match['date'] = date
+        # end while 1
+    finally:
+        fetcher.stop()
+        fetcher.join(5)
 
-            # write match to dynamodb table
-            try:
-                response = data_table.put_item(Item=match)
-                total_ad_matches += 1
-            except Exception as e:
-                log(match)
-                ex = e
-                break
-
-        if ex:
-            break
+    # The parts must be in S3 before moving latest_seq_num past their matches
+    try:
+        if fused and latest_seq_num != first_seq_num:
+            with deadline.timed('upload'):
+                aggregator.upload(latest_seq_num - 1, processed_bucket)
+        if raw_archive and raw_archive.first_seq_num is not None:
+            with deadline.timed('upload'):
+                raw_archive.upload(latest_seq_num)
+    finally:
+        if raw_archive:
+            raw_archive.close()
 
-        latest_seq_num = matches[-1]['match_seq_num'] + 1
-        # start_time is sometimes 0, skip the update if that is the case
-        if matches[-1]['start_time'] > 0:
-            latest_end_time = matches[-1]['start_time'] + matches[-1]['duration']
+    log("Total/AD matches: " + str(total_matches) + "/" + str(total_ad_matches))
+    metrics.count('Pages', n_pages)
+    metrics.gauge('PagesPerSecond', n_pages / (time.time() - ingest_start_time), 'Count/Second')
+    metrics.count('Matches', total_matches)
+    metrics.count('AdMatches', total_ad_matches)
 
-    # end while 1
+    return latest_seq_num, latest_end_time, at_head, ex
 
+def save_cursor(metadata_table, latest_seq_num, latest_end_time, event):
     latest_date = datetime.date.fromtimestamp(latest_end_time).isoformat()
 
     # Update latest_seq_num
@@ -169,8 +791,278 @@ def lambda_handler(event={}, context={}):
         }
     )
 
+    # process-data.py resumes from here if the fused mode is turned off
+    if event.get('fused', FUSED):
+        metadata_table.update_item(
+            Key={
+                'role': 'processed',
+            },
+            UpdateExpression='SET #ea1=:ea1, #ea2=:ea2, #ea3=:ea3',
+            ExpressionAttributeNames={
+                '#ea1': 'match_seq_num',
+                '#ea2': 'end_time',
+                '#ea3': 'date',
+            },
+            ExpressionAttributeValues={
+                ':ea1': latest_seq_num - 1,
+                ':ea2': latest_end_time,
+                ':ea3': latest_date,
+            },
+        )
+
+def load_shards(metadata_table):
+    ''' Shard rows by start seq num '''
+    shards = list()
+    params = {'FilterExpression': Attr('role').begins_with('shard-')}
+    while True:
+        response = metadata_table.scan(**params)
+        shards += response['Items']
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sorted(shards, key=lambda shard: shard['start_seq_num'])
+
+def start_workers(events, context):
+    function_name = getattr(context, 'function_name', None)
+    if function_name:
+        lambda_client = boto3.client('lambda')
+        while events:
+            try:
+                lambda_client.invoke(
+                    FunctionName=function_name,
+                    InvocationType='Event',
+                    Payload=json.dumps(events[0]),
+                )
+            except Exception as e:
+                log("Cannot start shard workers, working them here: " + str(e))
+                break
+            events.pop(0)
+    # Not on Lambda or not allowed to invoke, work the shards one after the other
+    for event in events:
+        try:
+            lambda_handler(event, context)
+        except Exception as e:
+            log(e)
+
+def drop_shard(metadata_table, shard, start_time):
+    ''' Delete the shard's row unless it is leased, returns whether it was '''
+    try:
+        metadata_table.delete_item(
+            Key={
+                'role': shard['role'],
+            },
+            ConditionExpression='#ea < :now',
+            ExpressionAttributeNames={
+                '#ea': 'lease_expires',
+            },
+            ExpressionAttributeValues={
+                ':now': int(start_time),
+            },
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    log("Dropped " + shard['role'])
+    return True
+
+def coordinate(metadata_table, shards, latest_seq_num, latest_end_time, start_time, workers, event, context):
+    ''' Advance latest_seq_num over the finished shards and into the first
+    unfinished one, add shards while behind and start a worker for each shard
+    not leased '''
+    # Advance over the contiguous finished prefix, then up to the first
+    # unfinished shard's checkpoint
+    cursor = latest_seq_num
+    advanced = list()
+    while shards and shards[0]['start_seq_num'] <= latest_seq_num:
+        shard = shards[0]
+        seq_num = int(shard['end_seq_num'] if shard['done'] else shard['match_seq_num'])
+        if seq_num > latest_seq_num:
+            latest_seq_num = seq_num
+            if shard['end_time']:
+                latest_end_time = shard['end_time']
+        if not shard['done']:
+            break
+        advanced.append(shards.pop(0))
+    if latest_seq_num != cursor:
+        save_cursor(metadata_table, latest_seq_num, latest_end_time, event)
+        log("Advanced to seq num " + str(latest_seq_num))
+    # Rows of shards latest_seq_num is already past, also left by a run that
+    # failed before deleting them
+    for shard in advanced + [shard for shard in shards if shard['end_seq_num'] <= latest_seq_num]:
+        metadata_table.delete_item(Key={'role': shard['role']})
+    shards = [shard for shard in shards if shard['end_seq_num'] > latest_seq_num]
+
+    # A worker that ran out of matches has seen the API head. Shards starting
+    # past it have nothing to work yet, and once latest_seq_num has reached
+    # the head's shard the backlog is gone, so the shards are dropped and the
+    # next run ingests inline with all the keys.
+    heads = [int(shard['match_seq_num']) for shard in shards if shard.get('at_head')]
+    head = min(heads) if heads else None
+    if head is not None:
+        shards = [shard for shard in shards
+                  if shard['start_seq_num'] < head or not drop_shard(metadata_table, shard, start_time)]
+        if len(shards) == 1 and shards[0]['start_seq_num'] <= latest_seq_num and shards[0].get('at_head'):
+            if drop_shard(metadata_table, shards[0], start_time):
+                return
+
+    # Add shards while the furthest one is still behind and short of the head
+    end_time = max([latest_end_time] + [shard['end_time'] for shard in shards])
+    seq_num = int(shards[-1]['end_seq_num']) if shards else latest_seq_num
+    shard_seq_nums = event.get('shard_seq_nums', SHARD_SEQ_NUMS)
+    while head is None and len(shards) < workers and start_time - float(end_time) > SHARD_BEHIND:
+        # Shards are worked with disjoint slots of the API keys, kept for
+        # their lifetime
+        key_slots = set(int(shard.get('key_slot', 0)) for shard in shards)
+        shard = {
+            'role': 'shard-%020d' % seq_num,
+            'start_seq_num': seq_num,
+            'end_seq_num': seq_num + shard_seq_nums,
+            'match_seq_num': seq_num,
+            'end_time': 0,
+            'done': False,
+            'at_head': False,
+            'lease_expires': 0,
+            'key_slot': min(set(range(workers)) - key_slots),
+            'key_slots': workers,
+        }
+        metadata_table.put_item(
+            Item=shard,
+            ConditionExpression='attribute_not_exists(#role)',
+            ExpressionAttributeNames={'#role': 'role'},
+        )
+        log("Added " + shard['role'] + " to seq num " + str(shard['end_seq_num']))
+        shards.append(shard)
+        seq_num += shard_seq_nums
+
+    events = list()
+    for shard in shards:
+        if not shard['done'] and shard['lease_expires'] < start_time:
+            events.append(dict(event, shard=shard['role']))
+    log("Starting " + str(len(events)) + " shard workers")
+    start_workers(events, context)
+
+def work_shard(metadata_table, event, context, start_time):
+    ''' Lease the shard named in the event and ingest it up to its end '''
+    role = event['shard']
+    owner = getattr(context, 'aws_request_id', None) or '%d-%f' % (os.getpid(), start_time)
+    deadline = Deadline(context, start_time, TIMEOUT)
+
+    try:
+        response = metadata_table.update_item(
+            Key={
+                'role': role,
+            },
+            UpdateExpression='SET #ea1=:ea1, #ea2=:ea2',
+            ConditionExpression='attribute_exists(#role) AND #done = :done AND #ea2 < :now',
+            ExpressionAttributeNames={
+                '#ea1': 'lease_owner',
+                '#ea2': 'lease_expires',
+                '#role': 'role',
+                '#done': 'done',
+            },
+            ExpressionAttributeValues={
+                ':ea1': owner,
+                ':ea2': int(deadline.end + LEASE_MARGIN),
+                ':done': False,
+                ':now': int(start_time),
+            },
+            ReturnValues='ALL_NEW',
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        log(role + " is leased or done, exiting.")
+        return
+    shard = response['Attributes']
+
+    response = metadata_table.get_item(
+        Key={
+            'role': 'dota_api_key'
+        }
+    )
+    dota_api_keys = response['Item']['dota_api_keys']
+    dota_api_keys = dota_api_keys[int(shard.get('key_slot', 0))::int(shard.get('key_slots', 1))]
+
+    log("Starting " + role + " at seq num " + str(shard['match_seq_num']) + " to " + str(shard['end_seq_num']))
+    seq_num, end_time, at_head, ex = ingest(int(shard['match_seq_num']), shard['end_time'], dota_api_keys,
+                                            deadline, event, end_seq_num=int(shard['end_seq_num']))
+
+    metadata_table.update_item(
+        Key={
+            'role': role,
+        },
+        UpdateExpression='SET #ea1=:ea1, #ea2=:ea2, #ea3=:ea3, #ea4=:ea4, #ea5=:ea5',
+        ConditionExpression='#owner = :owner',
+        ExpressionAttributeNames={
+            '#ea1': 'match_seq_num',
+            '#ea2': 'end_time',
+            '#ea3': 'done',
+            '#ea4': 'lease_expires',
+            '#ea5': 'at_head',
+            '#owner': 'lease_owner',
+        },
+        ExpressionAttributeValues={
+            ':ea1': seq_num,
+            ':ea2': end_time,
+            ':ea3': seq_num >= shard['end_seq_num'],
+            ':ea4': 0,
+            ':ea5': at_head,
+            ':owner': owner,
+        },
+    )
+
+    log("Finished " + role + " at seq num " + str(seq_num))
+
+    if ex:
+        raise ex
+
+@ad_common.emit_metrics(metrics)
+@profiler.profiled
+def lambda_handler(event={}, context={}):
+    start_time = time.time()
+
+    dynamodb = boto3.resource('dynamodb')
+    metadata_table = dynamodb.Table('ad-metadata')
+
+    if 'shard' in event:
+        work_shard(metadata_table, event, context, start_time)
+        return
+
+    response = metadata_table.get_item(
+        Key={
+            'role': 'latest_seq_num'
+        }
+    )
+    latest_seq_num = response['Item']['match_seq_num']
+    latest_date = response['Item'].get('date', "")
+    latest_end_time = response['Item'].get('end_time', 0)
+
+    response = metadata_table.get_item(
+        Key={
+            'role': 'dota_api_key'
+        }
+    )
+    # dota_api_key = response['Item']['dota_api_key']
+    dota_api_keys = response['Item']['dota_api_keys']
+
+    timediff=start_time-float(latest_end_time)
+    log("Starting at seq num " + str(latest_seq_num) + ", behind " + str(datetime.timedelta(seconds=timediff)))
+
+    # Shard the backlog, or keep working the shards until they are all done
+    workers = min(event.get('shard_workers', SHARD_WORKERS), len(dota_api_keys))
+    shards = load_shards(metadata_table)
+    if shards or (timediff > SHARD_BEHIND and workers > 1):
+        coordinate(metadata_table, shards, latest_seq_num, latest_end_time, start_time, workers, event, context)
+        return
+
+    deadline = Deadline(context, start_time, TIMEOUT)
+    latest_seq_num, latest_end_time, at_head, ex = ingest(latest_seq_num, latest_end_time, dota_api_keys,
+                                                          deadline, event)
+
+    save_cursor(metadata_table, latest_seq_num, latest_end_time, event)
+
     log("Finished at seq num " + str(latest_seq_num))
-    log("Total/AD matches: " + str(total_matches) + "/" + str(total_ad_matches))
 
     if ex:
         raise ex
@@ -1,14 +1,65 @@
 #!/usr/bin/python
 
 import boto3
+import os
+import imp
 import time
 import datetime
 from boto3.dynamodb.conditions import Key, Attr
 import collections
-import tempfile
+import heapq
+import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Metrics, profiling and Deadline, shared with the other functions
+ad_common = imp.load_source('ad_common', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ad-common.py'))
+
+# Seconds to run for when there is no Lambda context to take the deadline from
 TIMEOUT = 240
 
+# Seconds kept back from the Lambda deadline for the metadata update, and the
+# assumed seconds a unit of work takes until one has been measured. An
+# 'upload' is writing and uploading all of a date's part files.
+DEADLINE_RESERVE = 5
+UNIT_COSTS = {
+    'dynamodb_page': 2.0,
+    'upload': 10.0,
+}
+
+# Intermediate part/rollup files are 'csv' or 'packed', see ad-common.py.
+# Final publish files are always CSV.
+PART_FORMAT = 'csv'
+FORMAT_EXTENSIONS = {
+    'csv': '.csv',
+    'packed': '.adp',
+}
+
+# 'numpy' (dense count matrices) or 'counter' (collections.Counter), or
+# 'sketch' for bounded memory at the cost of approximate counts
+AGGREGATOR = 'numpy' if numpy else 'counter'
+
+# The 'sketch' aggregator keeps about SKETCH_CAPACITY keys of each of
+# SKETCH_TABLES, see SketchAggregator
+SKETCH_TABLES = ['item', 'combo']
+SKETCH_CAPACITY = 100000
+
+# Process several dates at once when at least CATCHUP_DAYS complete days
+# behind, one worker process per date
+CATCHUP_DAYS = 2
+CATCHUP_WORKERS = 4
+
+# Items per ad-data query page, None for DynamoDB's 1 MB pages
+QUERY_PAGE_SIZE = None
+# What decode_match reads, for both the full and the compact match shape
+MATCH_ATTRIBUTES = ['encoding', 'match_outcome', 'radiant_win', 'start_time', 'duration']
+PLAYER_ATTRIBUTES = ['hero_id', 'player_slot', 'ability_upgrades'] + \
+    ['item_%s' % item for item in range(0, 6)] + ['h', 's', 'a', 'i']
+MAX_PLAYERS = 10
+
 TABLES = {
     'single'  : { 'csv_header': 'ability'                  },
     'hero'    : { 'csv_header': 'hero,ability'             },
@@ -18,110 +69,187 @@ TABLES = {
     'item'    : { 'csv_header': 'ability,item'             },
 }
 
-def log(message):
-    print datetime.datetime.now().isoformat() + ' | ' + str(message)
+# Two part keys are packed into one int, see ad-common.py. Matches with ids
+# that don't fit are skipped when decoded and counted as InvalidIds.
+KEY_BITS = ad_common.KEY_BITS
+KEY_MASK = ad_common.KEY_MASK
+unpack_key = ad_common.unpack_key
+
+log = ad_common.log
+
+# Shared by the whole invocation
+metrics = ad_common.Metrics('process-data')
+profiler = ad_common.Profiler('process-data')
+
+def key_parts(header):
+    ''' Number of ids in the keys of a table with CSV header header '''
+    return header.count(',') + 1
+
+def ids_fit(ids):
+    ''' Whether all ids fit in a packed key '''
+    return not ids or max(ids) <= KEY_MASK
+
+def decode_match(match):
+    ''' (radiant_win, players, valid) of a match stored in ad-data
+
+    Reads both the full API match and the compact projection written by
+    get-data.py. players lists (hero, player_slot, abilities, items) with
+    the 5002 stat upgrade left out of abilities. A player without ability
+    upgrades makes the match invalid; only the players before it are
+    returned then. A hero, ability or item id too large to pack makes it
+    invalid without any players.
+
+    Ids are turned from Decimal into int up front, hashing and comparing
+    Decimals is far slower than the counting itself.
+    '''
+    players = list()
+
+    if match.get('encoding') == 'compact':
+        radiant_win = match['radiant_win']
+        for player in match['players']:
+            if 'a' not in player:
+                return radiant_win, players, False
+            abilities = set(map(int, player['a']))
+            abilities.discard(5002)
+            items = set(map(int, player['i']))
+            hero = int(player['h'])
+            if not (hero <= KEY_MASK and ids_fit(abilities) and ids_fit(items)):
+                metrics.count('InvalidIds')
+                return radiant_win, [], False
+            players.append((hero, int(player['s']), abilities, items))
+        return radiant_win, players, True
+
+    try:
+        radiant_win = (match["match_outcome"] == 2)
+    except:
+        radiant_win = match["radiant_win"]
+
+    for player in match["players"]:
+        if "ability_upgrades" not in player:
+            return radiant_win, players, False
+
+        abilities=set()
+        for upgrade in player["ability_upgrades"]:
+            ability = int(upgrade["ability"])
+            if ability != 5002:
+                abilities.add(ability)
+
+        # Make set of items
+        items=set()
+        for item in range(0,6):
+            item_i = int(player["item_%s" % item])
+            items.add(item_i)
+
+        hero = int(player["hero_id"])
+        if not (hero <= KEY_MASK and ids_fit(abilities) and ids_fit(items)):
+            metrics.count('InvalidIds')
+            return radiant_win, [], False
+        players.append((hero, int(player["player_slot"]), abilities, items))
+
+    return radiant_win, players, True
+
+def match_projection():
+    ''' ProjectionExpression and ExpressionAttributeNames for decode_match '''
+    names = {'#p': 'players'}
+    paths = list()
+    for i, attribute in enumerate(MATCH_ATTRIBUTES):
+        names['#m' + str(i)] = attribute
+        paths.append('#m' + str(i))
+    for i, attribute in enumerate(PLAYER_ATTRIBUTES):
+        names['#a' + str(i)] = attribute
+        for player in range(MAX_PLAYERS):
+            paths.append('#p[' + str(player) + '].#a' + str(i))
+    return ', '.join(paths), names
+
+class Prefetch(threading.Thread):
+    ''' Runs function(*args) in the background until result() is called '''
+    def __init__(self, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error:
+            raise self.error
+        return self.value
+
+def query_pages(data_table, date, seq_num, page_size=None):
+    ''' Query responses for date's matches after seq_num
+
+    Only the attributes decode_match reads are fetched. The next page is
+    queried in the background while the caller works on the current one.
+    '''
+    projection, names = match_projection()
+
+    def query(seq_num):
+        params = {
+            'KeyConditionExpression': Key('date').eq(str(date)) & Key('match_seq_num').gt(seq_num),
+            'ProjectionExpression': projection,
+            'ExpressionAttributeNames': names,
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+        if page_size:
+            params['Limit'] = page_size
+        return data_table.query(**params)
+
+    pending = Prefetch(query, seq_num)
+    while pending:
+        response = pending.result()
+        pending = None
+        if 'LastEvaluatedKey' in response:
+            pending = Prefetch(query, response['LastEvaluatedKey']['match_seq_num'])
+        yield response
 
 def write_csv(table, header, out_file):
     def stringify_key(key):
-        if type(key) == tuple:
-            return ','.join(map(str, key))
+        if n_parts == 2:
+            return '%d,%d' % unpack_key(key)
         else:
             return str(key)
 
-    with open(out_file, 'w') as fd:
+    n_parts = key_parts(header)
+    with ad_common.open_output(out_file, 'w') as fd:
         fd.write(header + ',total,wins\n')
-        for key in table['total']:
+        for key in sorted(table['total']):
             fd.write(stringify_key(key) + ',' + str(table['total'][key]) + ',' + str(table['wins'][key]) + '\n')
 
-def lambda_handler(event={}, context={}):
-    start_time = time.time()
-    timed_out = False;
+class CounterAggregator(object):
+    ''' The counter tables as collections.Counter pairs keyed by packed ids '''
+    def __init__(self):
+        # Counters {total, wins}
+        self.counters = dict()
+        for table in TABLES:
+            self.counters[table] = {'total': collections.Counter(), 'wins': collections.Counter()}
 
-    # Tables
-    dynamodb = boto3.resource('dynamodb')
-    data_table = dynamodb.Table('ad-data')
-    metadata_table = dynamodb.Table('ad-metadata')
+    def add_matches(self, matches):
+        counters = self.counters
 
-    # Get raw data info
-    response = metadata_table.get_item(
-        Key={
-            'role': 'latest_seq_num'
-        }
-    )
-    latest_seq_num = response['Item']['match_seq_num']
-    latest_date = response['Item'].get('date')
-    latest_date = datetime.datetime.strptime(latest_date, '%Y-%m-%d').date()
-    latest_end_time = response['Item'].get('end_time', 0)
+        def add_win(table, key):
+            counters[table]['total'][key] += 1
+            counters[table]['wins'][key] += 1
 
-    # Get processed data info
-    response = metadata_table.get_item(
-        Key={
-            'role': 'processed'
-        }
-    )
-    processed_seq_num = response['Item'].get('match_seq_num', 0)
-    process_seq_num = processed_seq_num
-    processed_date = response['Item'].get('date')
-    processed_date = datetime.datetime.strptime(processed_date, '%Y-%m-%d').date()
-    processed_end_time = response['Item'].get('end_time', 0)
-    processed_bucket = response['Item']['s3bucket']
-
-    # Cancel if within 3 hours of data collection
-    if latest_end_time - processed_end_time < 3*60*60:
-        log("Data processing is caught up, exiting.")
-        return
-
-    log("Starting at " + str(processed_date) + " Timestamp " + str(processed_end_time))
-
-    # Counters {total, wins}
-    counters = dict()
-    counters['single']  = {'total': collections.Counter(), 'wins': collections.Counter()}
-    counters['hero']    = {'total': collections.Counter(), 'wins': collections.Counter()}
-    counters['combo']   = {'total': collections.Counter(), 'wins': collections.Counter()}
-    counters['counter'] = {'total': collections.Counter(), 'wins': collections.Counter()}
-    counters['synergy'] = {'total': collections.Counter(), 'wins': collections.Counter()}
-    counters['item']    = {'total': collections.Counter(), 'wins': collections.Counter()}
-
-    def add_win(table, key):
-        counters[table]['total'][key] += 1
-        counters[table]['wins'][key] += 1
+        def add_loss(table, key):
+            counters[table]['total'][key] += 1
 
-    def add_loss(table, key):
-        counters[table]['total'][key] += 1
-
-    while True:
-
-        response = data_table.query(
-            KeyConditionExpression=Key('date').eq(str(processed_date)) & \
-                Key('match_seq_num').gt(process_seq_num)
-        )
-
-        if response['Count'] == 0:
-            break
-
-        for match in response['Items']:
-            try:
-                radiant_win = (match["match_outcome"] == 2)
-            except:
-                radiant_win = match["radiant_win"]
+        for radiant_win, players, valid in matches:
             abilities_win = set()
             abilities_lose = set()
-            invalid = False
 
-            for player in match["players"]:
+            for hero, player_slot, abilities, items in players:
                 win = False
-                abilities=set()
-                hero = player["hero_id"]
-
-                if "ability_upgrades" not in player:
-                    invalid = True
-                    break
-                for upgrade in player["ability_upgrades"]:
-                    ability = upgrade["ability"]
-                    if ability != 5002:
-                        abilities.add(ability)
-
-                if player["player_slot"] < 5:
+
+                if player_slot < 5:
                     if radiant_win == True:
                         abilities_win |= abilities
                         win = True
@@ -134,117 +262,539 @@ def lambda_handler(event={}, context={}):
                         win = True
                         abilities_win |= abilities
 
-                # Make set of items
-                items=set()
-                for item in range(0,6):
-                    item_i = player["item_%s" % item]
-                    items.add(item_i)
-
                 # Hero, Combo, Items
+                hero_key = hero << KEY_BITS
                 if win:
                     for ability in abilities:
-                        add_win('hero', (hero, ability))
+                        add_win('hero', hero_key | ability)
 
+                        ability_key = ability << KEY_BITS
                         for ability2 in abilities:
                             if ability < ability2:
-                                add_win('combo', (ability, ability2))
+                                add_win('combo', ability_key | ability2)
 
                         for item in items:
-                            add_win('item', (ability, item))
+                            add_win('item', ability_key | item)
 
                 if not win:
                     for ability in abilities:
-                        add_loss('hero', (hero, ability))
+                        add_loss('hero', hero_key | ability)
 
+                        ability_key = ability << KEY_BITS
                         for ability2 in abilities:
                             if ability < ability2:
-                                add_loss('combo', (ability, ability2))
+                                add_loss('combo', ability_key | ability2)
 
                         for item in items:
-                            add_loss('item', (ability, item))
+                            add_loss('item', ability_key | item)
 
             # end for player in match
 
-            if invalid:
+            if not valid:
                 continue
 
             # Single, Counter, Synergy
             for ability in abilities_win:
                 add_win('single', ability)
 
+                ability_key = ability << KEY_BITS
                 for ability2 in abilities_lose:
                     if ability < ability2:
-                        add_win('counter', (ability, ability2))
+                        add_win('counter', ability_key | ability2)
                     else:
-                        add_loss('counter', (ability2, ability))
+                        add_loss('counter', (ability2 << KEY_BITS) | ability)
 
                 for ability3 in abilities_win:
                     if ability < ability3:
-                        add_win('synergy', (ability, ability3))
+                        add_win('synergy', ability_key | ability3)
 
             for ability in abilities_lose:
                 add_loss('single', ability)
 
+                ability_key = ability << KEY_BITS
                 for ability2 in abilities_lose:
                     if ability < ability2:
-                        add_loss('synergy', (ability, ability2))
+                        add_loss('synergy', ability_key | ability2)
+
+    def tables(self):
+        return self.counters
+
+class NumpyAggregator(object):
+    ''' The counter tables as dense numpy count matrices
+
+    Ability, hero and item ids are mapped to dense indices. Each batch of
+    matches becomes 0/1 incidence matrices (player x ability, player x
+    item, player x hero, match x winning/losing abilities) whose products
+    give every pair count of the batch at once. Pair matrices are indexed
+    both ways; tables() folds them back into the packed (lower id, higher
+    id) keys CounterAggregator produces.
+    '''
+    def __init__(self):
+        self.ids = {'ability': list(), 'hero': list(), 'item': list()}
+        self.index = {'ability': dict(), 'hero': dict(), 'item': dict()}
+        self.sums = dict()
+
+    def lookup(self, kind, key):
+        index = self.index[kind]
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(self.ids[kind])
+            self.ids[kind].append(int(key))
+        return i
+
+    def accumulate(self, name, counts):
+        counts = numpy.rint(counts).astype(numpy.int64)
+        current = self.sums.get(name)
+        if current is None:
+            self.sums[name] = counts
+            return
+        if current.shape != counts.shape:
+            # New ids only ever append rows/columns
+            grown = numpy.zeros(counts.shape, dtype=numpy.int64)
+            grown[tuple(slice(0, n) for n in current.shape)] = current
+            current = self.sums[name] = grown
+        current += counts
+
+    def add_matches(self, matches):
+        lookup = self.lookup
+        player_abilities = (list(), list())
+        player_items = (list(), list())
+        player_heroes = list()
+        player_wins = list()
+        match_win = (list(), list())
+        match_lose = (list(), list())
+        n_players = 0
+        n_matches = 0
+
+        for radiant_win, players, valid in matches:
+            for hero, player_slot, abilities, items in players:
+                win = (player_slot < 5) == (radiant_win == True)
+                match_set = match_win if win else match_lose
+
+                for ability in abilities:
+                    a = lookup('ability', ability)
+                    player_abilities[0].append(n_players)
+                    player_abilities[1].append(a)
+                    if valid:
+                        match_set[0].append(n_matches)
+                        match_set[1].append(a)
+                for item in items:
+                    player_items[0].append(n_players)
+                    player_items[1].append(lookup('item', item))
+                player_heroes.append(lookup('hero', hero))
+                player_wins.append(win)
+                n_players += 1
+
+            if valid:
+                n_matches += 1
+
+        if n_players == 0:
+            return
+
+        n_abilities = len(self.ids['ability'])
+        n_items = len(self.ids['item'])
+        n_heroes = len(self.ids['hero'])
+
+        def incidence(rows, n_rows, cols, n_cols):
+            matrix = numpy.zeros((n_rows, n_cols), dtype=numpy.float32)
+            matrix[rows, cols] = 1
+            return matrix
+
+        # Per player: Hero, Combo, Items
+        wins = numpy.array(player_wins, dtype=bool)
+        P = incidence(player_abilities[0], n_players, player_abilities[1], n_abilities)
+        Q = incidence(player_items[0], n_players, player_items[1], n_items)
+        H = incidence(range(n_players), n_players, player_heroes, n_heroes)
+        Pw, Qw, Hw = P[wins], Q[wins], H[wins]
+
+        self.accumulate('hero_total', H.T.dot(P))
+        self.accumulate('hero_wins', Hw.T.dot(Pw))
+        self.accumulate('combo_total', P.T.dot(P))
+        self.accumulate('combo_wins', Pw.T.dot(Pw))
+        self.accumulate('item_total', P.T.dot(Q))
+        self.accumulate('item_wins', Pw.T.dot(Qw))
+
+        # Per valid match: Single, Counter, Synergy
+        W = incidence(match_win[0], n_matches, match_win[1], n_abilities)
+        L = incidence(match_lose[0], n_matches, match_lose[1], n_abilities)
+        WW = W.T.dot(W)
+
+        self.accumulate('single_total', W.sum(axis=0) + L.sum(axis=0))
+        self.accumulate('single_wins', W.sum(axis=0))
+        self.accumulate('counter_wl', W.T.dot(L))
+        self.accumulate('synergy_total', WW + L.T.dot(L))
+        self.accumulate('synergy_wins', WW)
+
+    def tables(self):
+        ability_ids = numpy.array(self.ids['ability'], dtype=numpy.int64)
+        hero_ids = numpy.array(self.ids['hero'], dtype=numpy.int64)
+        item_ids = numpy.array(self.ids['item'], dtype=numpy.int64)
+        n_abilities = len(ability_ids)
+        below = ability_ids[:, None] < ability_ids[None, :]
+
+        def sums(name, shape):
+            # All ids may have shown up after the last batch using them
+            counts = numpy.zeros(shape, dtype=numpy.int64)
+            current = self.sums.get(name)
+            if current is not None:
+                counts[tuple(slice(0, n) for n in current.shape)] = current
+            return counts
+
+        def table(keys, total, wins):
+            if len(keys) == 1:
+                keys = keys[0].tolist()
+            else:
+                keys = ((keys[0] << KEY_BITS) | keys[1]).tolist()
+            return {
+                'total': dict(zip(keys, total.tolist())),
+                'wins': dict(zip(keys, wins.tolist())),
+            }
+
+        tables = dict()
+
+        total = sums('single_total', (n_abilities,))
+        wins = sums('single_wins', (n_abilities,))
+        i, = numpy.nonzero(total)
+        tables['single'] = table((ability_ids[i],), total[i], wins[i])
+
+        for name, row_ids, col_ids, pairs in (
+            ('hero', hero_ids, ability_ids, False),
+            ('item', ability_ids, item_ids, False),
+            ('combo', ability_ids, ability_ids, True),
+            ('synergy', ability_ids, ability_ids, True),
+        ):
+            total = sums(name + '_total', (len(row_ids), len(col_ids)))
+            wins = sums(name + '_wins', (len(row_ids), len(col_ids)))
+            mask = total > 0
+            if pairs:
+                mask &= below
+            i, j = numpy.nonzero(mask)
+            tables[name] = table((row_ids[i], col_ids[j]), total[i, j], wins[i, j])
+
+        # counter_wl[a, b] counts a on the winning side against b. Keys are
+        # (lower id, higher id), a win when the lower id was on the winning
+        # side; an ability facing itself is a loss.
+        wl = sums('counter_wl', (n_abilities, n_abilities))
+        total = wl + wl.T
+        numpy.fill_diagonal(total, wl.diagonal())
+        wins = wl * below
+        i, j = numpy.nonzero((total > 0) & (below | numpy.eye(n_abilities, dtype=bool)))
+        tables['counter'] = table((ability_ids[i], ability_ids[j]), total[i, j], wins[i, j])
+
+        return tables
+
+class SketchAggregator(CounterAggregator):
+    ''' CounterAggregator keeping only the heavy hitters of SKETCH_TABLES
+
+    Each of those tables is a Misra-Gries summary weighted by total: when a
+    batch of matches leaves it with more than twice capacity keys, the
+    (capacity + 1)th largest total is taken off every total, and off every
+    wins as far as it goes, and the keys left without games are dropped.
+    Memory is bounded by 2 * capacity keys plus what one batch adds.
+
+    Error bounds, N being the number of games counted in the table (the sum
+    of its exact totals) and error the sum of what was taken off, which is
+    recorded as the SketchError<Table> metric:
+    - every total and wins is an underestimate by at most error
+    - error <= N / (capacity + 1), as each prune takes its amount off at
+      least capacity + 1 keys
+    - every key with more than error games is kept
+    Parts are summed into rollups and publish files, so the error of those
+    is at most the sum of the errors of their parts, which is still at most
+    N / (capacity + 1) for the N games they count.
+
+    Wins are reduced by the same error as totals, so win rates are biased
+    low: a key's estimated rate (wins - error) / (total - error) is below its
+    exact rate by error * (1 - rate) / (total - error). That is small only
+    for keys with many more games than the error.
+    '''
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        CounterAggregator.__init__(self)
+        self.capacity = capacity
+
+    def add_matches(self, matches):
+        CounterAggregator.add_matches(self, matches)
+        for table in SKETCH_TABLES:
+            if len(self.counters[table]['total']) > 2 * self.capacity:
+                self.prune(table)
+
+    def prune(self, table):
+        total = self.counters[table]['total']
+        wins = self.counters[table]['wins']
+        error = heapq.nlargest(self.capacity + 1, total.itervalues())[-1]
+
+        for key, count in total.items():
+            if count <= error:
+                del total[key]
+                del wins[key]
+            else:
+                total[key] = count - error
+                if wins[key] > error:
+                    wins[key] -= error
+                else:
+                    del wins[key]
+
+        log("pruned " + table + " to " + str(len(total)) + " keys, error " + str(error))
+        metrics.count('SketchError' + table.title(), error)
+
+AGGREGATORS = {
+    'counter': CounterAggregator,
+    'numpy': NumpyAggregator,
+    'sketch': SketchAggregator,
+}
+
+def write_packed(table, header, out_file):
+    rows = ((key, table['total'][key], table['wins'][key]) for key in sorted(table['total']))
+    ad_common.write_packed_rows(rows, out_file, header + ',total,wins\n')
+
+WRITERS = {
+    'csv': write_csv,
+    'packed': write_packed,
+}
+
+def rollup_ancestors(date):
+    ''' Names of the rollup tree nodes above date's own, see ad-common.py '''
+    names = list()
+    for node_type in ad_common.NODE_TYPES[:-1]:
+        start = ad_common.node_start(date, node_type)
+        if start:
+            names.append(ad_common.node_name((start, node_type)))
+    return names
+
+def invalidate_rollups(s3_client, bucket, date):
+    ''' Delete the rollups holding date, publish rebuilds them with new parts '''
+    s3_keys = [name + '/' + table + extension
+               for name in rollup_ancestors(date)
+               for table in TABLES
+               for extension in FORMAT_EXTENSIONS.values()]
+    s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={
+            'Objects': [{'Key': s3_key} for s3_key in s3_keys],
+            'Quiet': True,
+        },
+    )
+
+# Shared by warm invocations
+unit_costs = dict()
+
+class Deadline(ad_common.Deadline):
+    ''' ad_common.Deadline with DEADLINE_RESERVE and UNIT_COSTS '''
+    def __init__(self, context, start_time, timeout, costs=unit_costs):
+        super(Deadline, self).__init__(context, start_time, timeout, DEADLINE_RESERVE, UNIT_COSTS, costs)
+
+def process_date(date, seq_num, deadline, bucket, options, upload_partial=True):
+    ''' Aggregate date's matches after seq_num and upload the part files
+
+    Returns a dict with the seq num reached, the end time of the last valid
+    match (None if there was none), whether the whole date was read and
+    the read capacity consumed. Nothing is uploaded for a partial run
+    unless upload_partial is set.
+    '''
+    timed_out = False
+    process_seq_num = seq_num
+    end_time = None
+    capacity = 0
 
-            processed_end_time = match['start_time'] + match['duration']
+    dynamodb = boto3.resource('dynamodb')
+    data_table = dynamodb.Table('ad-data')
+
+    aggregator = AGGREGATORS[options['aggregator']]()
+
+    page_start_time = time.time()
+    for response in query_pages(data_table, date, seq_num, options['page_size']):
+        page_capacity = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+        capacity += page_capacity
+        metrics.count('DynamoDbReadCapacity', page_capacity)
 
-        # end for match in response
+        if response['Count'] == 0:
+            break
+
+        matches = list()
+        for match in response['Items']:
+            decoded = decode_match(match)
+            matches.append(decoded)
+            if decoded[2]:
+                end_time = match['start_time'] + match['duration']
 
+        aggregator.add_matches(matches)
+        metrics.count('QueryPages')
+        metrics.count('Matches', len(matches))
+        metrics.time('QueryPageTime', time.time() - page_start_time)
 
         if 'LastEvaluatedKey' in response:
-            log(str(response['Count']) + " : " + str(response['LastEvaluatedKey']))
+            log(str(date) + " " + str(response['Count']) + " : " + str(response['LastEvaluatedKey']))
             process_seq_num = response['LastEvaluatedKey']['match_seq_num']
         else:
-            log(str(response['Count']))
+            log(str(date) + " " + str(response['Count']))
             break
 
-        # Timeout?
-        if time.time() - start_time > TIMEOUT:
+        deadline.record('dynamodb_page', time.time() - page_start_time)
+        page_start_time = time.time()
+
+        # Timeout? Another page and the upload must still fit
+        if not deadline.fits('dynamodb_page', 'upload'):
             timed_out = True
             break
 
-    # end while True
+    # end for response
+
+    log(str(date) + " consumed " + str(capacity) + " read capacity units")
+
+    result = {
+        'date': date,
+        'seq_num': process_seq_num,
+        'end_time': end_time,
+        'completed': not timed_out,
+        'capacity': capacity,
+    }
+    if timed_out and not upload_partial:
+        return result
+
+    with deadline.timed('upload'), metrics.timer('UploadTime'):
+        upload_parts(aggregator, date, seq_num, process_seq_num, bucket, options['part_format'])
 
-    # Generate files, upload to S3
-    temp_dir = tempfile.mkdtemp()
-    s3_suffix = '.part' + str(processed_seq_num) + '-' + str(process_seq_num)
+    return result
+
+def upload_parts(aggregator, date, seq_num, process_seq_num, bucket, part_format):
+    ''' Upload date's part files for the matches after seq_num up to
+    process_seq_num. Also used by get-data.py's fused mode. '''
+    # Generate files, streamed to S3
+    s3_suffix = '.part' + str(seq_num) + '-' + str(process_seq_num)
     s3_client = boto3.client('s3')
+    counters = aggregator.tables()
     for key in counters:
-        s3_key = key + s3_suffix + '.csv'
-        filename = temp_dir + '/' + s3_key
-        # log('writing ' + filename)
-        write_csv(counters[key], TABLES[key]['csv_header'], filename)
-
-        s3_obj = str(processed_date) + '/' + s3_key
+        metrics.count('TableKeys' + key.title(), len(counters[key]['total']))
+        s3_obj = str(date) + '/' + key + s3_suffix + FORMAT_EXTENSIONS[part_format]
         log('uploading ' + s3_obj)
-        s3_client.upload_file(filename, processed_bucket, s3_obj)
+        writer = ad_common.S3Writer(s3_client, bucket, s3_obj, metrics)
+        WRITERS[part_format](counters[key], TABLES[key]['csv_header'], writer)
+
+    invalidate_rollups(s3_client, bucket, date)
+
+def process_dates(dates, seq_num, deadline, bucket, options):
+    ''' process_date for each date concurrently, one worker process per date
+
+    Only the first date may leave a partial part file behind; later dates
+    upload nothing unless they complete, so they can simply be started
+    over.
+    '''
+    calls = [(str(date), process_date, (date, seq_num if i == 0 else 0, deadline, bucket, options, i == 0))
+             for i, date in enumerate(dates)]
+    return [result for result, _ in ad_common.run_workers(calls, len(calls), metrics, profiler)]
+
+@ad_common.emit_metrics(metrics)
+@profiler.profiled
+def lambda_handler(event={}, context={}):
+    start_time = time.time()
+    deadline = Deadline(context, start_time, TIMEOUT)
+
+    # Tables
+    dynamodb = boto3.resource('dynamodb')
+    metadata_table = dynamodb.Table('ad-metadata')
 
-    # Completed the day
-    if (not timed_out) and (latest_date != processed_date):
+    # Get raw data info
+    response = metadata_table.get_item(
+        Key={
+            'role': 'latest_seq_num'
+        }
+    )
+    latest_seq_num = response['Item']['match_seq_num']
+    latest_date = response['Item'].get('date')
+    latest_date = datetime.datetime.strptime(latest_date, '%Y-%m-%d').date()
+    latest_end_time = response['Item'].get('end_time', 0)
+
+    # Get processed data info
+    response = metadata_table.get_item(
+        Key={
+            'role': 'processed'
+        }
+    )
+    processed_seq_num = response['Item'].get('match_seq_num', 0)
+    processed_date = response['Item'].get('date')
+    processed_date = datetime.datetime.strptime(processed_date, '%Y-%m-%d').date()
+    processed_end_time = response['Item'].get('end_time', 0)
+    processed_bucket = response['Item']['s3bucket']
+    # Dates completed ahead of processed_date by catch-up runs, with their end times
+    completed = response['Item'].get('completed', dict())
+
+    # Cancel if within 3 hours of data collection
+    if latest_end_time - processed_end_time < 3*60*60:
+        log("Data processing is caught up, exiting.")
+        return
+
+    log("Starting at " + str(processed_date) + " Timestamp " + str(processed_end_time))
+
+    options = {
+        'aggregator': event.get('aggregator', AGGREGATOR),
+        'page_size': event.get('query_page_size', QUERY_PAGE_SIZE),
+        'part_format': event.get('part_format', PART_FORMAT),
+    }
+    workers = event.get('catchup_workers', CATCHUP_WORKERS)
+    days_behind = (latest_date - processed_date).days
+
+    if days_behind >= CATCHUP_DAYS and workers > 1:
+        # Only complete days, the latest one is still being collected
+        dates = list()
+        date = processed_date
+        while len(dates) < workers and date < latest_date:
+            if str(date) not in completed:
+                dates.append(date)
+            date += datetime.timedelta(days=1)
+        log("Catching up " + ", ".join(map(str, dates)))
+        results = process_dates(dates, processed_seq_num, deadline, processed_bucket, options)
+    else:
+        results = [process_date(processed_date, processed_seq_num, deadline,
+                                processed_bucket, options)]
+
+    ex = None
+    capacity = 0
+    for result in results:
+        if isinstance(result, Exception):
+            ex = result
+            continue
+        capacity += result['capacity']
+        if result['completed'] and result['date'] < latest_date:
+            completed[str(result['date'])] = result['end_time'] or 0
+
+    log("Consumed " + str(capacity) + " read capacity units")
+
+    # Advance over the contiguous completed prefix
+    head = results[0]
+    if isinstance(head, dict) and head['date'] == processed_date:
+        processed_seq_num = head['seq_num']
+        if head['end_time'] is not None:
+            processed_end_time = head['end_time']
+    while str(processed_date) in completed:
+        end_time = completed.pop(str(processed_date))
+        if end_time:
+            processed_end_time = end_time
         processed_date += datetime.timedelta(days=1)
-        process_seq_num = 0
+        processed_seq_num = 0
 
     # Update latest_seq_num
     metadata_table.update_item(
         Key={
             'role': 'processed',
         },
-        UpdateExpression='SET #ea1=:ea1, #ea2=:ea2, #ea3=:ea3',
+        UpdateExpression='SET #ea1=:ea1, #ea2=:ea2, #ea3=:ea3, #ea4=:ea4',
         ExpressionAttributeNames={
             '#ea1': 'match_seq_num',
             '#ea2': 'end_time',
             '#ea3': 'date',
+            '#ea4': 'completed',
         },
         ExpressionAttributeValues={
-            ':ea1': process_seq_num,
+            ':ea1': processed_seq_num,
             ':ea2': processed_end_time,
             ':ea3': str(processed_date),
+            ':ea4': completed,
         },
     )
 
+    if ex:
+        raise ex
+
 if __name__ == '__main__':
     log('Enter')
     lambda_handler()
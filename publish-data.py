@@ -10,14 +10,61 @@ import collections
 import cPickle as pickle
 import tempfile
 import os
+import imp
 import errno
+import hashlib
+import shutil
+import heapq
+import threading
+import Queue
 
-# This script has no timeout. Progress is incrementally saved in S3 such that
-# if it were to be killed, the next call will pick up almost where it left off.
+# Metrics, profiling and Deadline, shared with the other functions
+ad_common = imp.load_source('ad_common', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ad-common.py'))
+
+# This script has no timeout of its own. On Lambda it stops before a table it
+# predicts won't fit before the deadline. Progress is incrementally saved in
+# S3 such that if it were to stop or be killed, the next call will pick up
+# almost where it left off.
 
 start_time = time.time()
 ONE_DAY = datetime.timedelta(days=1)
 
+# Intermediate part/rollup files are 'csv' or 'packed', see ad-common.py.
+# Final publish files are always CSV.
+INTERMEDIATE_FORMAT = 'csv'
+
+# Publish a moved window from the previous publish plus the new days minus
+# the expired ones, instead of merging the whole window again. Only done
+# when none of the rollups that went into the previous publish, recorded in
+# a 'publish-rollups-<table>' ad-metadata row, has changed since, and when
+# the recorded rollups are at most WINDOW_MAX_ROLLUPS to check.
+PUBLISH_INCREMENTAL = True
+WINDOW_MAX_ROLLUPS = 64
+
+# Minimum total a key needs to be published, by table, for instance
+# {'item': 10, 'combo': 10} to cut their long tail of pairs seen in a
+# handful of games. Published counts stay exact, and rollups keep every
+# key. A table with a minimum goes to its own publish file, which is never
+# built incrementally: its previous publish lacks the keys that were below
+# the minimum then.
+MIN_SUPPORT = dict()
+
+# Number of threads downloading rollups and parts from S3, per table
+S3_CONCURRENCY = 8
+
+# Downloaded and generated objects are kept in CACHE_DIR across warm
+# invocations, least recently used first out past CACHE_BYTES, split evenly
+# between the tables
+CACHE_DIR = '/tmp/ad-cache'
+CACHE_BYTES = 256 * 1024 * 1024
+
+# 'stream' merges sorted inputs with a k-way merge, 'memory' sums them in dicts
+MERGE_MODE = 'stream'
+FORMAT_EXTENSIONS = {
+    'csv': '.csv',
+    'packed': '.adp',
+}
+
 TABLES = {
     'single'  : { 'csv_header': 'ability'                  },
     'hero'    : { 'csv_header': 'hero,ability'             },
@@ -27,32 +74,37 @@ TABLES = {
     'item'    : { 'csv_header': 'ability,item'             },
 }
 
-def log(message):
-    print datetime.datetime.now().isoformat() + ' | ' + str(message)
-
-def get_next_month(date):
-    if date.month < 12:
-        return datetime.date(year=date.year, month=date.month+1, day=1)
-    else:
-        return datetime.date(year=date.year+1, month=1, day=1)
-
-def split_date_ranges(start_date, end_date):
-    ''' list of tuples (start_date, type=('day' | 'month')) '''
-    if start_date > end_date:
-        raise Exception("start_date > end_date")
-
-    if start_date == end_date:
-        return [(start_date, 'day')]
-
-    next_month = get_next_month(start_date)
-    if (start_date.day == 1 and
-        next_month - ONE_DAY <= end_date):
-        if next_month - ONE_DAY == end_date:
-            return [(start_date, 'month')]
-        else:
-            return [(start_date, 'month')] + split_date_ranges(next_month, end_date)
-    else:
-        return [(start_date, 'day')] + split_date_ranges(start_date + ONE_DAY, end_date)
+# Two part keys are packed into one int as they are read, see ad-common.py,
+# and only unpacked when a file is written
+KEY_BITS = ad_common.KEY_BITS
+KEY_MASK = ad_common.KEY_MASK
+pack_key = ad_common.pack_key
+unpack_key = ad_common.unpack_key
+
+# Seconds kept back from the Lambda deadline for index.json and the metadata
+# update, and the assumed seconds to merge and upload each table until one
+# has been measured
+DEADLINE_RESERVE = 10
+UNIT_COSTS = dict((table, 30.0) for table in TABLES)
+
+# Tables are merged in up to PUBLISH_WORKERS processes at once, merging is
+# CPU bound
+PUBLISH_WORKERS = len(TABLES)
+
+log = ad_common.log
+
+# Shared by the whole invocation
+metrics = ad_common.Metrics('publish-data')
+profiler = ad_common.Profiler('publish-data')
+
+# The rollup tree, see ad-common.py
+NODE_TYPES = ad_common.NODE_TYPES
+get_next_month = ad_common.get_next_month
+node_start = ad_common.node_start
+node_end = ad_common.node_end
+node_name = ad_common.node_name
+node_children = ad_common.node_children
+split_date_ranges = ad_common.split_date_ranges
 
 def mkdir_p(path):
     try:
@@ -63,175 +115,652 @@ def mkdir_p(path):
         else:
             raise
 
+def stringify_key(key, n_parts):
+    if n_parts == 2:
+        return '%d,%d' % unpack_key(key)
+    else:
+        return str(key)
+
+def table_rows(table):
+    ''' (key, total, wins) rows of a {total, wins} table in key order '''
+    for key in sorted(table['total']):
+        yield key, table['total'][key], table['wins'][key]
+
+def write_csv_rows(rows, out_file, full_header):
+    n_parts = len(full_header.split(',')) - 2
+    with ad_common.open_output(out_file, 'w') as fd:
+        fd.write(full_header)
+        for key, total, wins in rows:
+            fd.write(stringify_key(key, n_parts) + ',' + str(total) + ',' + str(wins) + '\n')
+
+ROW_WRITERS = {
+    'csv': write_csv_rows,
+    'packed': ad_common.write_packed_rows,
+}
+
 def write_csv(table, out_file, header=None, full_header=None):
-    def stringify_key(key):
-        if type(key) == tuple:
-            return ','.join(map(str, key))
-        else:
-            return str(key)
+    assert(header or full_header)
+    assert(not header or not full_header)
+
+    write_csv_rows(table_rows(table), out_file, full_header or header + ',total,wins\n')
 
+def write_packed(table, out_file, header=None, full_header=None):
     assert(header or full_header)
     assert(not header or not full_header)
 
-    with open(out_file, 'w') as fd:
-        if header:
-            fd.write(header + ',total,wins\n')
+    ad_common.write_packed_rows(table_rows(table), out_file, full_header or header + ',total,wins\n')
+
+def read_csv_rows(fd, header_len):
+    with fd:
+        for line in fd:
+            if header_len == 3:
+                key, total, wins = line.split(',')
+                key = int(key)
+            if header_len == 4:
+                k1, k2, total, wins = line.split(',')
+                key = pack_key(int(k1), int(k2))
+            yield key, int(total), int(wins)
+
+def read_table(filename):
+    ''' (header, rows) of a CSV or packed file, rows as (key, total, wins) '''
+    fd = open(filename, 'rb')
+    if fd.read(len(ad_common.PACKED_MAGIC)) == ad_common.PACKED_MAGIC:
+        return ad_common.read_packed(fd)
+
+    fd.seek(0)
+    header = fd.readline()
+    return header, read_csv_rows(fd, len(header.split(',')))
+
+class UnsortedInput(Exception):
+    pass
+
+class InconsistentCounts(Exception):
+    pass
+
+def check_counts(rows):
+    ''' Rows, raising InconsistentCounts past one with a negative total or
+    wins, or more wins than games, which subtracting counts that were not
+    added leaves '''
+    for row in rows:
+        if not 0 <= row[2] <= row[1]:
+            raise InconsistentCounts(str(row[0]) + ',' + str(row[1]) + ',' + str(row[2]))
+        yield row
+
+def check_sorted(rows, filename):
+    previous = None
+    for row in rows:
+        if previous is not None and row[0] < previous:
+            raise UnsortedInput(filename)
+        previous = row[0]
+        yield row
+
+def merge_rows(row_lists):
+    ''' Sorted rows of the sorted row_lists, summed by key '''
+    current = None
+    for key, total, wins in heapq.merge(*row_lists):
+        if current and current[0] == key:
+            current[1] += total
+            current[2] += wins
         else:
-            fd.write(full_header)
-        for key in table['total']:
-            fd.write(stringify_key(key) + ',' + str(table['total'][key]) + ',' + str(table['wins'][key]) + '\n')
+            if current:
+                yield current
+            current = [key, total, wins]
+    if current:
+        yield current
+
+def negate_rows(rows):
+    for key, total, wins in rows:
+        yield key, -total, -wins
 
-def merge_csv(in_files, out_file):
+def merge_in_memory(in_files, subtract_files=()):
     table = dict()
     table = {'total': dict(), 'wins': dict()}
 
-    for filename in in_files:
+    for filename in list(in_files) + list(subtract_files):
         first_header = None
 
-        with open(filename, 'r') as fd:
-            header = fd.readline()
-            header_len = len(header.split(','))
+        header, rows = read_table(filename)
+        if filename in subtract_files:
+            rows = negate_rows(rows)
 
-            if first_header:
-                assert(first_header == header)
+        if first_header:
+            assert(first_header == header)
+        else:
+            first_header = header
+
+        for key, total, wins in rows:
+            if key in table['total']:
+                table['total'][key] += total
             else:
-                first_header = header
-
-            for line in fd:
-                if header_len == 3:
-                    key, total, wins = line.split(',')
-                if header_len == 4:
-                    k1, k2, total, wins = line.split(',')
-                    key = ','.join([k1, k2])
-
-                if key in table['total']:
-                    table['total'][key] += int(total)
-                else:
-                    table['total'][key] = int(total)
-
-                if key in table['wins']:
-                    table['wins'][key] += int(wins)
-                else:
-                    table['wins'][key] = int(wins)
-
-    if out_file:
-        # log('write_csv ' + out_file)
-        write_csv(table, out_file, full_header=first_header)
-
-def merge_day(table, date, bucket_name, temp_dir):
+                table['total'][key] = total
+
+            if key in table['wins']:
+                table['wins'][key] += wins
+            else:
+                table['wins'][key] = wins
+
+    for key in table['total'].keys():
+        if subtract_files and not 0 <= table['wins'][key] <= table['total'][key]:
+            raise InconsistentCounts(str(key) + ',' + str(table['total'][key]) + ',' + str(table['wins'][key]))
+        if not table['total'][key]:
+            del table['total'][key]
+            del table['wins'][key]
+
+    return first_header, table
+
+def merge_csv(in_files, out_file, out_format='csv', subtract_files=(), min_support=0):
+    ''' Sum in_files by key into out_file, minus subtract_files
+
+    In 'stream' MERGE_MODE the sorted inputs are merged with a k-way heap
+    merge, holding one row per input in memory. Inputs written before keys
+    were sorted are detected while merging and make it start over in
+    memory. Keys subtracted down to a zero total are dropped, as are keys
+    with a total below min_support. Subtracting more than a key has raises
+    InconsistentCounts.
+    '''
+    if not out_file:
+        return
+
+    if MERGE_MODE == 'stream':
+        filenames = list(in_files) + list(subtract_files)
+        tables = [read_table(filename) for filename in filenames]
+        if tables:
+            try:
+                rows = [check_sorted(rows, filename) for filename, (_, rows) in zip(filenames, tables)]
+                rows = rows[:len(in_files)] + [negate_rows(r) for r in rows[len(in_files):]]
+                rows = merge_rows(rows)
+                if subtract_files:
+                    rows = check_counts(rows)
+                rows = (row for row in rows if row[1])
+                if min_support:
+                    rows = (row for row in rows if row[1] >= min_support)
+                ROW_WRITERS[out_format](rows, out_file, tables[0][0])
+                return
+            except UnsortedInput as e:
+                log('unsorted input ' + str(e) + ', merging in memory')
+            finally:
+                # Closes the inputs the merge didn't read to the end
+                for _, input_rows in tables:
+                    input_rows.close()
+
+    first_header, table = merge_in_memory(in_files, subtract_files)
+    rows = table_rows(table)
+    if min_support:
+        rows = (row for row in rows if row[1] >= min_support)
+    # log('write_csv ' + out_file)
+    ROW_WRITERS[out_format](rows, out_file, first_header)
+
+def rollup_keys(prefix, table):
+    ''' S3 keys a rollup may be stored under, INTERMEDIATE_FORMAT first '''
+    formats = [INTERMEDIATE_FORMAT] + [f for f in sorted(FORMAT_EXTENSIONS) if f != INTERMEDIATE_FORMAT]
+    return [prefix + '/' + table + FORMAT_EXTENSIONS[f] for f in formats]
+
+class ObjectCache(object):
+    ''' Local copies of S3 objects, keyed by bucket, key and ETag
+
+    Entries are revalidated with a conditional GET, so an unchanged object
+    costs a 304 instead of a download. Entries in use by a publish are
+    pinned and not evicted until unpinned.
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def cache_filename(self, bucket_name, s3_key, etag):
+        return self.cache_dir + '/' + hashlib.sha1(bucket_name + '/' + s3_key + '/' + etag).hexdigest()
+
+    def get(self, s3_client, bucket_name, s3_key):
+        ''' Pinned local copy of an object, None if there is none '''
+        entry = self.lookup(bucket_name, s3_key)
+        if entry and not os.path.isfile(entry['filename']):
+            # Removed behind the cache's back, a 304 would leave nothing to read
+            self.unpin(bucket_name, s3_key)
+            self.discard(bucket_name, s3_key)
+            entry = None
+        params = {'Bucket': bucket_name, 'Key': s3_key}
+        if entry:
+            params['IfNoneMatch'] = entry['etag']
+
+        try:
+            response = s3_client.get_object(**params)
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if entry and code in ('304', 'NotModified'):
+                metrics.count('CacheHits')
+                return entry['filename']
+            if entry:
+                self.unpin(bucket_name, s3_key)
+                self.discard(bucket_name, s3_key)
+            if code in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+        mkdir_p(self.cache_dir)
+        filename = self.cache_filename(bucket_name, s3_key, response['ETag'])
+        fd, download_filename = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as fd:
+            for chunk in iter(lambda: response['Body'].read(ad_common.READ_CHUNK), ''):
+                fd.write(chunk)
+        os.rename(download_filename, filename)
+        metrics.count('CacheMisses')
+        metrics.count('BytesDownloaded', os.path.getsize(filename), 'Bytes')
+
+        self.add(bucket_name, s3_key, response['ETag'], filename)
+        if entry:
+            self.unpin(bucket_name, s3_key)
+        return filename
+
+    def put(self, s3_client, bucket_name, s3_key, filename):
+        ''' Cache a file just uploaded as an object '''
+        etag = s3_client.head_object(Bucket=bucket_name, Key=s3_key)['ETag']
+
+        mkdir_p(self.cache_dir)
+        cache_filename = self.cache_filename(bucket_name, s3_key, etag)
+        link_filename = tempfile.mktemp(dir=self.cache_dir)
+        try:
+            os.link(filename, link_filename)
+        except OSError:
+            shutil.copyfile(filename, link_filename)
+        os.rename(link_filename, cache_filename)
+
+        self.add(bucket_name, s3_key, etag, cache_filename)
+        self.unpin(bucket_name, s3_key)
+
+    def etag(self, bucket_name, s3_key):
+        ''' ETag of the cached object, None if it is not cached '''
+        with self.lock:
+            entry = self.entries.get((bucket_name, s3_key))
+            return entry['etag'] if entry else None
+
+    def lookup(self, bucket_name, s3_key):
+        with self.lock:
+            entry = self.entries.pop((bucket_name, s3_key), None)
+            if entry:
+                entry['pins'] += 1
+                self.entries[(bucket_name, s3_key)] = entry
+            return entry
+
+    def add(self, bucket_name, s3_key, etag, filename):
+        with self.lock:
+            previous = self.entries.pop((bucket_name, s3_key), None)
+            if previous and previous['filename'] == filename:
+                self.n_bytes -= previous['size']
+            elif previous:
+                self.remove(previous)
+
+            entry = {
+                'etag': etag,
+                'filename': filename,
+                'size': os.path.getsize(filename),
+                'pins': (previous['pins'] if previous else 0) + 1,
+            }
+            self.entries[(bucket_name, s3_key)] = entry
+            self.n_bytes += entry['size']
+            self.evict()
+
+        return filename
+
+    def unpin(self, bucket_name, s3_key):
+        with self.lock:
+            entry = self.entries.get((bucket_name, s3_key))
+            if entry and entry['pins']:
+                entry['pins'] -= 1
+                self.evict()
+
+    def discard(self, bucket_name, s3_key):
+        with self.lock:
+            entry = self.entries.pop((bucket_name, s3_key), None)
+            if entry:
+                self.remove(entry)
+
+    def evict(self):
+        for key in self.entries.keys():
+            if self.n_bytes <= self.max_bytes:
+                break
+            if not self.entries[key]['pins']:
+                self.remove(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.n_bytes = 0
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def remove(self, entry):
+        self.n_bytes -= entry['size']
+        if os.path.exists(entry['filename']):
+            os.remove(entry['filename'])
+
+# Shared by the invocations of a warm container. One per table, so that the
+# processes publishing the tables each manage their own.
+object_caches = dict((table, ObjectCache(CACHE_DIR + '/' + table, CACHE_BYTES // len(TABLES)))
+                     for table in TABLES)
+
+class Download(object):
+    def __init__(self):
+        self.landed = threading.Event()
+        self.filename = None
+        self.s3_key = None
+
+    def wait(self):
+        self.landed.wait()
+        return self.filename
+
+class S3Fetcher(object):
+    ''' Downloads S3 objects into the object cache with a pool of threads
+    sharing one client. fetch() queues a download and returns at once, get()
+    waits for it to land, so merging can start on the first files while the
+    rest are still being downloaded. Generated files go to temp_dir.
+    '''
+    def __init__(self, temp_dir, concurrency, cache):
+        self.temp_dir = temp_dir
+        self.cache = cache
+        self.s3_client = boto3.client('s3')
+        self.requests = Queue.Queue()
+        self.downloads = dict()
+        self.lock = threading.Lock()
+
+        self.threads = list()
+        for _ in range(concurrency):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def local_filename(self, bucket_name, s3_key):
+        return self.temp_dir + '/' + bucket_name + '/' + s3_key
+
+    def output_filename(self, bucket_name, s3_key):
+        ''' local_filename for a file to generate '''
+        filename = self.local_filename(bucket_name, s3_key)
+        mkdir_p(os.path.dirname(filename))
+        return filename
+
+    def fetch(self, bucket_name, s3_keys):
+        ''' Queue a download of the first of s3_keys found '''
+        request = (bucket_name, tuple(s3_keys))
+        with self.lock:
+            if request not in self.downloads:
+                self.downloads[request] = Download()
+                self.requests.put(request)
+            return self.downloads[request]
+
+    def get(self, bucket_name, s3_keys):
+        ''' Local copy of the first of s3_keys found, None if there is none '''
+        return self.fetch(bucket_name, s3_keys).wait()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            bucket_name, s3_keys = request
+            download = self.downloads[request]
+            try:
+                for s3_key in s3_keys:
+                    download.filename = self.download(bucket_name, s3_key)
+                    if download.filename:
+                        download.s3_key = s3_key
+                        break
+            finally:
+                download.landed.set()
+
+    def download(self, bucket_name, s3_key):
+        filename = self.local_filename(bucket_name, s3_key)
+        if os.path.isfile(filename):
+            return filename
+
+        # log('get ' + s3_key)
+        try:
+            return self.cache.get(self.s3_client, bucket_name, s3_key)
+        except:
+            return None
+
+    def upload(self, filename, bucket_name, s3_key):
+        log('uploading ' + bucket_name + '/' + s3_key)
+        self.s3_client.upload_file(filename, bucket_name, s3_key)
+        metrics.count('BytesUploaded', os.path.getsize(filename), 'Bytes')
+        self.cache.put(self.s3_client, bucket_name, s3_key, filename)
+
+    def writer(self, bucket_name, s3_key):
+        ''' S3Writer for an object to generate, see written() '''
+        log('uploading ' + bucket_name + '/' + s3_key)
+        return ad_common.S3Writer(self.s3_client, bucket_name, s3_key, metrics, self.output_filename(bucket_name, s3_key))
+
+    def written(self, writer):
+        ''' Cache the object of a writer that has been closed '''
+        self.cache.put(self.s3_client, writer.bucket_name, writer.s3_key, writer.copy_filename)
+
+    def delete(self, bucket_name, s3_key):
+        self.s3_client.delete_object(Bucket=bucket_name, Key=s3_key)
+        self.cache.discard(bucket_name, s3_key)
+
+    def close(self):
+        for thread in self.threads:
+            self.requests.put(None)
+
+        # Let the cache evict what this publish used
+        with self.lock:
+            downloads = self.downloads.items()
+        for (bucket_name, _), download in downloads:
+            if download.wait() and download.filename.startswith(self.cache.cache_dir):
+                self.cache.unpin(bucket_name, download.s3_key)
+
+def merge_day(table, date, bucket_name, fetcher):
+    ''' Day rollup of the day's parts and of its previous rollup, if any, None
+    if there are no parts to add to the previous rollup '''
     date = str(date)
-    path = temp_dir + '/' + bucket_name
+    s3_keys = rollup_keys(date, table)
     prefix = date + '/' + table + '.part'
-    final_obj = date + '/' + table + '.csv'
+    final_obj = s3_keys[0]
 
-    files = list()
-    s3_client = boto3.client('s3')
+    s3_client = fetcher.s3_client
     response = s3_client.list_objects(Bucket=bucket_name, Prefix=prefix)
-    for content in response['Contents']:
-        s3_obj = content['Key']
-        filename = path + '/' + s3_obj
-        # log('download ' + filename)
-        s3_client.download_file(bucket_name, s3_obj, filename)
-        files.append(filename)
+    parts = [content['Key'] for content in response.get('Contents', [])]
+    for s3_obj in parts:
+        fetcher.fetch(bucket_name, [s3_obj])
 
-    # Generate file
-    filename = path + '/' + final_obj
-    merge_csv(files, filename)
+    download = fetcher.fetch(bucket_name, s3_keys)
+    rollup = download.wait()
+    if not parts:
+        if not rollup:
+            raise Exception("no parts or rollup for " + date + "/" + table)
+        return None
 
-    # Upload to S3
-    log('uploading ' + bucket_name + '/' + final_obj)
-    s3_client.upload_file(filename, bucket_name, final_obj)
+    files = list()
+    if rollup:
+        # A late part, fold it into the rollup
+        log('adding ' + str(len(parts)) + ' parts to ' + download.s3_key)
+        files.append(rollup)
+    for s3_obj in parts:
+        files.append(fetcher.get(bucket_name, [s3_obj]))
 
-    # Delete partial files
-    for content in response['Contents']:
-        s3_client.delete_object(Bucket=bucket_name, Key=content['Key'])
+    # Generate file
+    filename = fetcher.output_filename(bucket_name, final_obj)
+    with metrics.timer('MergeTimeDay'):
+        merge_csv(files, filename, INTERMEDIATE_FORMAT)
 
-def get_day(table, date, bucket_name, temp_dir):
-    date = str(date)
-    s3_key = date + '/' + table + '.csv'
-    filename = temp_dir + '/' + bucket_name + '/' + s3_key
+    # Upload to S3
+    fetcher.upload(filename, bucket_name, final_obj)
 
-    if os.path.isfile(filename):
-        return filename
+    # Delete partial files, and a previous rollup in another format
+    for s3_obj in parts:
+        fetcher.delete(bucket_name, s3_obj)
+    if rollup and download.s3_key != final_obj:
+        fetcher.delete(bucket_name, download.s3_key)
 
-    mkdir_p(os.path.dirname(filename))
+    return filename
 
-    s3_client = boto3.client('s3')
-    # log('get ' + s3_key)
-    try:
-        s3_client.download_file(bucket_name, s3_key, filename)
-    except:
-        # log('not found, generating ' + s3_key)
-        merge_day(table, date, bucket_name, temp_dir)
+def get_day(table, date, bucket_name, fetcher):
+    return (merge_day(table, date, bucket_name, fetcher) or
+            fetcher.get(bucket_name, rollup_keys(str(date), table)))
 
-    return filename
+def merge_node(table, node, bucket_name, fetcher):
+    final_obj = rollup_keys(node_name(node), table)[0]
 
-def merge_month(table, date, bucket_name, temp_dir):
-    month = datetime.datetime.strftime(date, '%Y-%m')
-    path = temp_dir + '/' + bucket_name
-    final_obj = month + '/' + table + '.csv'
+    children = node_children(node)
+    for child in children:
+        fetcher.fetch(bucket_name, rollup_keys(node_name(child), table))
 
     files = list()
-    assert(date.day == 1)
-    end_date = get_next_month(date) - ONE_DAY
-    current_date = date;
-    while current_date <= end_date:
-        filename = get_day(table, current_date, bucket_name, temp_dir)
+    for child in children:
+        filename = get_node(table, child, bucket_name, fetcher)
         # log(filename)
         files.append(filename)
 
-        current_date = current_date + ONE_DAY
-
     # Generate file
-    filename = path + '/' + final_obj
-    merge_csv(files, filename)
+    filename = fetcher.output_filename(bucket_name, final_obj)
+    with metrics.timer('MergeTime' + node[1].title()):
+        merge_csv(files, filename, INTERMEDIATE_FORMAT)
 
     # Upload to S3
-    s3_client = boto3.client('s3')
-    log('uploading ' + bucket_name + '/' + final_obj)
-    s3_client.upload_file(filename, bucket_name, final_obj)
-
-def get_month(table, date, bucket_name, temp_dir):
-    month = datetime.datetime.strftime(date, '%Y-%m')
-    s3_key = month + '/' + table + '.csv'
-    filename = temp_dir + '/' + bucket_name + '/' + s3_key
+    fetcher.upload(filename, bucket_name, final_obj)
 
-    if os.path.isfile(filename):
-        return filename
+def get_node(table, node, bucket_name, fetcher):
+    ''' Local copy of a node's rollup, generated from its children if missing '''
+    if node[1] == 'day':
+        return get_day(table, node[0], bucket_name, fetcher)
 
-    mkdir_p(os.path.dirname(filename))
+    s3_keys = rollup_keys(node_name(node), table)
 
-    s3_client = boto3.client('s3')
-    # log('get ' + s3_key)
-    try:
-        s3_client.download_file(bucket_name, s3_key, filename)
-    except:
-        # log('not found, generating ' + s3_key)
-        merge_month(table, date, bucket_name, temp_dir)
+    filename = fetcher.get(bucket_name, s3_keys)
+    if not filename:
+        # log('not found, generating ' + s3_keys[0])
+        merge_node(table, node, bucket_name, fetcher)
+        filename = fetcher.local_filename(bucket_name, s3_keys[0])
 
     return filename
 
-def merge_data(table, start_date, end_date, bucket_name, out_file):
-    timed_out = False;
-
-    get_function = {
-        'day': get_day,
-        'month': get_month,
-    }
+def prefetch_data(table, start_date, end_date, bucket_name, fetcher):
+    for node in split_date_ranges(start_date, end_date):
+        fetcher.fetch(bucket_name, rollup_keys(node_name(node), table))
 
+def get_data(table, start_date, end_date, bucket_name, fetcher):
+    ''' Local rollups covering start_date to end_date '''
     files = list()
-    temp_dir = tempfile.mkdtemp()
     for date_range in split_date_ranges(start_date, end_date):
         # log('get ' + str(date_range[1]) + ': ' + str(date_range[0]))
 
-        filename = get_function[date_range[1]](table, date_range[0], bucket_name, temp_dir)
+        filename = get_node(table, date_range, bucket_name, fetcher)
         # log(filename)
         files.append(filename)
 
-    merge_csv(files, out_file)
+    return files
+
+def merge_data(table, start_date, end_date, bucket_name, out_file, fetcher=None, min_support=0):
+    timed_out = False;
+
+    own_fetcher = not fetcher
+    if own_fetcher:
+        fetcher = S3Fetcher(tempfile.mkdtemp(), S3_CONCURRENCY, object_caches[table])
+    prefetch_data(table, start_date, end_date, bucket_name, fetcher)
+
+    try:
+        merge_csv(get_data(table, start_date, end_date, bucket_name, fetcher), out_file, min_support=min_support)
+    finally:
+        if own_fetcher:
+            fetcher.close()
+            shutil.rmtree(fetcher.temp_dir, ignore_errors=True)
+
+def range_difference(start_date, end_date, other_start, other_end):
+    ''' (start, end) ranges of the days from start_date to end_date outside
+    other_start to other_end '''
+    ranges = list()
+    if start_date < other_start:
+        ranges.append((start_date, min(end_date, other_start - ONE_DAY)))
+    if end_date > other_end:
+        ranges.append((max(start_date, other_end + ONE_DAY), end_date))
+    return ranges
+
+def window_ranges(start_date, end_date, previous):
+    ''' Ranges to add to and subtract from the previous publish, a tuple
+    (start_date, end_date), to get start_date to end_date. None if that
+    takes no fewer files than merging the window. '''
+    previous_start, previous_end = previous
+    if start_date > previous_end or end_date < previous_start:
+        return None
+
+    added = range_difference(start_date, end_date, previous_start, previous_end)
+    expired = range_difference(previous_start, previous_end, start_date, end_date)
+
+    n_files = 1 + sum(len(split_date_ranges(*r)) for r in added + expired)
+    if n_files >= len(split_date_ranges(start_date, end_date)):
+        return None
+    return added, expired
+
+def merge_window(table, start_date, end_date, previous_file, ranges, bucket_name, out_file, fetcher):
+    ''' Like merge_data, from the previous publish of table and the ranges
+    from window_ranges. Counts are additive so the result is the same. '''
+    added, expired = ranges
+
+    files = [previous_file]
+    for range_start, range_end in added:
+        files += get_data(table, range_start, range_end, bucket_name, fetcher)
+
+    subtract_files = list()
+    for range_start, range_end in expired:
+        subtract_files += get_data(table, range_start, range_end, bucket_name, fetcher)
+
+    merge_csv(files, out_file, subtract_files=subtract_files)
+
+def node_rollup(table, node, bucket_name, fetcher):
+    ''' Record of the rollup of a node that went into a publish, see
+    PUBLISH_INCREMENTAL '''
+    for s3_key in rollup_keys(node_name(node), table):
+        etag = fetcher.cache.etag(bucket_name, s3_key)
+        if not etag:
+            try:
+                etag = fetcher.s3_client.head_object(Bucket=bucket_name, Key=s3_key)['ETag']
+            except botocore.exceptions.ClientError:
+                continue
+        return {'start': str(node[0]), 'type': node[1], 'key': s3_key, 'etag': etag}
+    raise Exception("no rollup for " + node_name(node) + "/" + table)
+
+def record_node(record):
+    return datetime.datetime.strptime(record['start'], '%Y-%m-%d').date(), record['type']
+
+def load_rollups(table, previous, bucket_name, s3_client):
+    ''' Records of the rollups that went into the previous publish of table,
+    None if there are none or some have changed since '''
+    metadata_table = boto3.resource('dynamodb').Table('ad-metadata')
+    item = metadata_table.get_item(Key={'role': 'publish-rollups-' + table}).get('Item')
+    if not item or (item['start_date'], item['end_date']) != tuple(map(str, previous)):
+        log('no rollups recorded for the previous ' + table + ' publish')
+        return None
+    if len(item['rollups']) > WINDOW_MAX_ROLLUPS:
+        return None
+
+    # Late parts, fused mode parts and replays all change the day's objects
+    # and delete the rollups above it
+    for record in item['rollups']:
+        prefix = node_name(record_node(record)) + '/' + table + '.'
+        response = s3_client.list_objects(Bucket=bucket_name, Prefix=prefix)
+        objects = dict((content['Key'], content['ETag']) for content in response.get('Contents', []))
+        if objects != {record['key']: record['etag']}:
+            log(prefix + ' changed since the previous publish')
+            return None
+
+    return item['rollups']
+
+def save_rollups(table, start_date, end_date, rollups):
+    metadata_table = boto3.resource('dynamodb').Table('ad-metadata')
+    metadata_table.put_item(
+        Item={
+            'role': 'publish-rollups-' + table,
+            'start_date': str(start_date),
+            'end_date': str(end_date),
+            'rollups': rollups,
+        }
+    )
 
-def publish_data(start_date, end_date, processed_bucket, publish_bucket, endpoint):
-    s3_prefix = (
+def publish_prefix(start_date, end_date):
+    return (
         'publish-' +
         datetime.datetime.strftime(start_date, '%Y%m%d') +
         '-' +
@@ -239,36 +768,176 @@ def publish_data(start_date, end_date, processed_bucket, publish_bucket, endpoin
         '-'
     )
 
-    index = dict()
+def publish_key(start_date, end_date, table, min_support=0):
+    ''' S3 key of table's publish file, see MIN_SUPPORT '''
+    if min_support:
+        return publish_prefix(start_date, end_date) + table + '.min' + str(min_support) + '.csv'
+    return publish_prefix(start_date, end_date) + table + '.csv'
+
+# Shared by warm invocations
+unit_costs = dict()
+
+class Deadline(ad_common.Deadline):
+    ''' ad_common.Deadline with DEADLINE_RESERVE and UNIT_COSTS '''
+    def __init__(self, context, start_time, timeout=None, costs=unit_costs):
+        super(Deadline, self).__init__(context, start_time, timeout, DEADLINE_RESERVE, UNIT_COSTS, costs)
+
+def publish_table(table, start_date, end_date, processed_bucket, publish_bucket, concurrency, previous, min_support):
+    ''' Generate table's publish file for start_date to end_date, streaming it
+    to S3. Returns the seconds it took, None if it was already published. '''
+    publish_start_time = time.time()
+    min_support = min_support.get(table, 0)
+    s3_key = publish_key(start_date, end_date, table, min_support)
+
     temp_dir = tempfile.mkdtemp()
-    s3_client = boto3.client('s3')
-    for table in TABLES:
-        s3_key = s3_prefix + table + '.csv'
-        filename = temp_dir + '/' + s3_key
-        index[table] = 'http://' + endpoint + '/' + s3_key
+    fetcher = S3Fetcher(temp_dir, concurrency, object_caches[table])
+    try:
+        if fetcher.get(publish_bucket, [s3_key]):
+            return None
+
+        ranges = None
+        if previous and previous != (start_date, end_date) and not min_support:
+            previous_key = publish_key(previous[0], previous[1], table)
+            previous_file = fetcher.get(publish_bucket, [previous_key])
+            if previous_file:
+                ranges = window_ranges(start_date, end_date, previous)
+            if ranges:
+                rollups = load_rollups(table, previous, processed_bucket, fetcher.s3_client)
+                if rollups is None:
+                    ranges = None
+
+        # Queue every rollup of the table, in the order they are merged
+        if ranges:
+            for range_start, range_end in ranges[0] + ranges[1]:
+                prefetch_data(table, range_start, range_end, processed_bucket, fetcher)
+        else:
+            prefetch_data(table, start_date, end_date, processed_bucket, fetcher)
 
-        # log('get ' + s3_key)
-        try:
-            s3_client.download_file(publish_bucket, s3_key, filename)
-        except:
-            # log('not found, generating ' + s3_key)
-            merge_data(table, start_date, end_date, processed_bucket, filename)
+        # log('not found, generating ' + s3_key)
+        writer = fetcher.writer(publish_bucket, s3_key)
+        with metrics.timer('MergeTimePublish'):
+            if ranges:
+                log('updating ' + previous_key)
+                try:
+                    merge_window(table, start_date, end_date, previous_file, ranges,
+                                 processed_bucket, writer, fetcher)
+                except InconsistentCounts as e:
+                    # The writer was aborted and starts over. A new fetcher
+                    # sees the rollups generated meanwhile, not what was
+                    # missing before.
+                    log('inconsistent counts ' + str(e) + ', merging the whole window')
+                    ranges = None
+                    fetcher.close()
+                    fetcher = S3Fetcher(temp_dir, concurrency, object_caches[table])
+            if not ranges:
+                merge_data(table, start_date, end_date, processed_bucket, writer, fetcher, min_support)
+        fetcher.written(writer)
+
+        if ranges:
+            # What is left of the previous window, and the new days
+            rollups = [record for record in rollups
+                       if record_node(record)[0] <= end_date and node_end(record_node(record)) >= start_date]
+            for range_start, range_end in ranges[0]:
+                rollups += [node_rollup(table, node, processed_bucket, fetcher)
+                            for node in split_date_ranges(range_start, range_end)]
+        else:
+            rollups = [node_rollup(table, node, processed_bucket, fetcher)
+                       for node in split_date_ranges(start_date, end_date)]
+        if not min_support:
+            save_rollups(table, start_date, end_date, rollups)
+    finally:
+        fetcher.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    seconds = time.time() - publish_start_time
+    metrics.time('PublishTime' + table.title(), seconds)
+    return seconds
+
+def cache_state(table):
+    ''' What a worker cached for table, for the parent to take over, also
+    when it failed after evicting files '''
+    cache = object_caches[table]
+    return cache.entries, cache.n_bytes
+
+def publish_tables(tables, args, workers):
+    ''' publish_table for each table, in up to workers processes at once.
+    Returns the result or exception of each table. '''
+    results = dict()
+    if workers <= 1:
+        for table in tables:
+            try:
+                results[table] = publish_table(table, *args)
+            except Exception as e:
+                results[table] = e
+        return results
+
+    calls = [(table, publish_table, (table,) + args) for table in tables]
+    for table, (result, state) in zip(tables, ad_common.run_workers(calls, workers, metrics, profiler, cache_state)):
+        cache = object_caches[table]
+        if state is None:
+            # What the worker evicted is unknown
+            cache.clear()
+        else:
+            cache.entries, cache.n_bytes = state
+        results[table] = result
+
+    return results
+
+def publish_data(start_date, end_date, processed_bucket, publish_bucket, endpoint, concurrency=S3_CONCURRENCY, previous=None,
+                 deadline=None, workers=PUBLISH_WORKERS, min_support=MIN_SUPPORT):
+    ''' Publish start_date to end_date. previous is the (start_date, end_date)
+    of the last publish, to build the tables from incrementally. min_support
+    is the minimum total of the keys published, by table, see MIN_SUPPORT.
+
+    The tables are published concurrently, see PUBLISH_WORKERS. Returns False
+    without uploading index.json when the deadline leaves no time for a
+    table; the tables done so far are kept for the next call.
+    '''
+    if deadline is None:
+        deadline = Deadline(None, time.time())
+
+    # Slowest first, so that a batch of workers takes about as long as its
+    # first table
+    tables = sorted(TABLES, key=deadline.cost, reverse=True)
+    skipped = [table for table in tables if not deadline.fits(table)]
+    for table in skipped:
+        log("Not enough time left for " + table + ", stopping")
+    tables = [table for table in tables if table not in skipped]
+
+    args = (start_date, end_date, processed_bucket, publish_bucket, concurrency, previous, min_support)
+    results = publish_tables(tables, args, workers)
+
+    ex = None
+    for table in tables:
+        if isinstance(results[table], Exception):
+            ex = results[table]
+        elif results[table] is not None:
+            deadline.record(table, results[table])
+    if ex:
+        raise ex
+    if skipped:
+        return False
 
-            log('uploading ' + publish_bucket + '/' + s3_key)
-            s3_client.upload_file(filename, publish_bucket, s3_key)
+    index = dict()
+    for table in TABLES:
+        index[table] = 'http://' + endpoint + '/' + publish_key(start_date, end_date, table, min_support.get(table, 0))
 
     s3_key = 'index.json'
     index['timestamp'] = int(time.time())
     index['start_date'] = str(start_date)
     index['end_date'] = str(end_date)
-    filename = temp_dir + '/' + s3_key
-    with open(filename, 'w') as fd:
-        json.dump(index, fd)
 
     log('uploading ' + publish_bucket + '/' + s3_key)
-    s3_client.upload_file(filename, publish_bucket, s3_key)
+    with ad_common.S3Writer(boto3.client('s3'), publish_bucket, s3_key, metrics) as writer:
+        json.dump(index, writer)
+
+    return True
 
+@ad_common.emit_metrics(metrics)
+@profiler.profiled
 def lambda_handler(event={}, context={}):
+    deadline = Deadline(context, time.time())
+
     # Tables
     dynamodb = boto3.resource('dynamodb')
     metadata_table = dynamodb.Table('ad-metadata')
@@ -284,6 +953,10 @@ def lambda_handler(event={}, context={}):
         publish_date = datetime.datetime.strptime(publish_date, '%Y-%m-%d').date()
     start_date = response['Item'].get('start_date')
     start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    # Start of the window last published, start_date may have moved since
+    published_start_date = response['Item'].get('published_start_date', None)
+    if published_start_date:
+        published_start_date = datetime.datetime.strptime(published_start_date, '%Y-%m-%d').date()
     publish_bucket = response['Item']['s3bucket']
     endpoint = response['Item']['endpoint']
 
@@ -305,18 +978,30 @@ def lambda_handler(event={}, context={}):
     end_date = processed_date - ONE_DAY
     log("Starting publish " + str(start_date) + " to " + str(end_date))
 
-    publish_data(start_date=start_date, end_date=end_date, processed_bucket=processed_bucket, publish_bucket=publish_bucket, endpoint=endpoint)
+    previous = None
+    if event.get('incremental', PUBLISH_INCREMENTAL) and publish_date and published_start_date:
+        previous = (published_start_date, publish_date)
+
+    concurrency = event.get('s3_concurrency', S3_CONCURRENCY)
+    workers = event.get('publish_workers', PUBLISH_WORKERS)
+    min_support = event.get('min_support', MIN_SUPPORT)
+    if not publish_data(start_date=start_date, end_date=end_date, processed_bucket=processed_bucket, publish_bucket=publish_bucket, endpoint=endpoint, concurrency=concurrency, previous=previous,
+                        deadline=deadline, workers=workers, min_support=min_support):
+        log("Publish continues next call")
+        return
 
     metadata_table.update_item(
         Key={
             'role': 'publish',
         },
-        UpdateExpression='SET #ea1=:ea1',
+        UpdateExpression='SET #ea1=:ea1, #ea2=:ea2',
         ExpressionAttributeNames={
             '#ea1': 'date',
+            '#ea2': 'published_start_date',
         },
         ExpressionAttributeValues={
             ':ea1': str(end_date),
+            ':ea2': str(start_date),
         },
     )
 
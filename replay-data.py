@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+import boto3
+import datetime
+import os
+import imp
+import struct
+import zlib
+import tempfile
+import argparse
+import multiprocessing
+
+# Reprocesses the raw pages archived by get-data.py (see RAW_ARCHIVE there)
+# into day rollups, without touching the API or ad-data. Pages go through
+# the current filter of get-data.py and aggregation of process-data.py, one
+# archive segment per worker process.
+
+ONE_DAY = datetime.timedelta(days=1)
+READ_CHUNK = 1 << 20
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+ad_common = imp.load_source('ad_common', os.path.join(PATH, 'ad-common.py'))
+get_data = imp.load_source('get_data', os.path.join(PATH, 'get-data.py'))
+process_data = imp.load_source('process_data', os.path.join(PATH, 'process-data.py'))
+
+log = ad_common.log
+
+def list_segments(s3_client, bucket, start_date, end_date):
+    ''' (key, first seq num, next seq num) of the segments that may hold
+    matches of start_date to end_date, by first seq num '''
+    segments = list()
+    # A segment is dated by the last match of its first page, so it may hold
+    # matches of the days around its date
+    date = start_date - ONE_DAY
+    while date <= end_date + ONE_DAY:
+        paginator = s3_client.get_paginator('list_objects')
+        for response in paginator.paginate(Bucket=bucket, Prefix='raw/' + str(date) + '/'):
+            for content in response.get('Contents', []):
+                name = os.path.basename(content['Key'])[:-len('.seg')]
+                first_seq_num, next_seq_num = map(int, name.split('-'))
+                segments.append((content['Key'], first_seq_num, next_seq_num))
+        date += ONE_DAY
+
+    return sorted(segments, key=lambda segment: segment[1])
+
+def plan_segments(segments):
+    ''' (key, from seq num, to seq num) for each segment, so that a run that
+    was retried and archived the same pages twice only counts them once '''
+    plan = list()
+    seq_num = 0
+    for s3_key, first_seq_num, next_seq_num in segments:
+        if next_seq_num <= seq_num:
+            continue
+        plan.append((s3_key, max(first_seq_num, seq_num), next_seq_num))
+        seq_num = next_seq_num
+    return plan
+
+def segment_runs(plan):
+    ''' Run number of each planned segment by key, segments of a run being
+    contiguous in seq nums '''
+    runs = dict()
+    run = 0
+    seq_num = None
+    for s3_key, from_seq_num, to_seq_num in plan:
+        if seq_num is not None and from_seq_num != seq_num:
+            log("gap in the archive from seq num " + str(seq_num) + " to " + str(from_seq_num))
+            run += 1
+        runs[s3_key] = run
+        seq_num = to_seq_num
+    return runs
+
+def read_segment(filename):
+    ''' (seq num, body) of each page of a segment file '''
+    with open(filename, 'rb') as fd:
+        if fd.read(len(get_data.RAW_MAGIC)) != get_data.RAW_MAGIC:
+            raise Exception("not a segment: " + filename)
+        decompressor = zlib.decompressobj()
+        data = ''
+        for chunk in iter(lambda: fd.read(READ_CHUNK), ''):
+            data += decompressor.decompress(chunk)
+            pos = 0
+            while len(data) - pos >= 12:
+                seq_num, length = struct.unpack('<QI', data[pos:pos + 12])
+                if len(data) - pos < 12 + length:
+                    break
+                yield seq_num, data[pos + 12:pos + 12 + length]
+                pos += 12 + length
+            data = data[pos:]
+        if data + decompressor.flush():
+            raise Exception("truncated segment: " + filename)
+
+def replay_segment(args):
+    ''' (s3_key, first date, last date, tables by date) of the accepted
+    matches of a segment from from_seq_num up to to_seq_num. The dates are
+    those of all its matches in that range, None if it has none. '''
+    bucket, s3_key, from_seq_num, to_seq_num, dates, options = args
+
+    temp_dir = tempfile.mkdtemp()
+    filename = temp_dir + '/segment'
+    boto3.client('s3').download_file(bucket, s3_key, filename)
+
+    encode_match = get_data.MATCH_ENCODINGS[options['match_encoding']]
+    aggregators = dict()
+    first_date = last_date = None
+    for seq_num, body in read_segment(filename):
+        matches = dict()
+        for match in get_data.parse_page(body)['matches']:
+            if not from_seq_num <= match['match_seq_num'] < to_seq_num:
+                continue
+            first_date = min(first_date or match['date'], match['date'])
+            last_date = max(last_date, match['date'])
+            if match['date'] not in dates:
+                continue
+            decoded = process_data.decode_match(encode_match(match))
+            matches.setdefault(match['date'], list()).append(decoded)
+
+        for date in matches:
+            if date not in aggregators:
+                aggregators[date] = process_data.AGGREGATORS[options['aggregator']]()
+            aggregators[date].add_matches(matches[date])
+
+    os.remove(filename)
+    os.rmdir(temp_dir)
+    return s3_key, first_date, last_date, dict((date, aggregators[date].tables()) for date in aggregators)
+
+def add_tables(tables, other):
+    for name in other:
+        if name not in tables:
+            tables[name] = other[name]
+            continue
+        for column in ('total', 'wins'):
+            counts = tables[name][column]
+            for key, count in other[name][column].iteritems():
+                counts[key] = counts.get(key, 0) + count
+
+def upload_day(s3_client, bucket, date, tables, part_format):
+    ''' Replace date's rollups and parts with tables '''
+    extension = process_data.FORMAT_EXTENSIONS[part_format]
+    for name in tables:
+        s3_key = str(date) + '/' + name + extension
+        log('uploading ' + bucket + '/' + s3_key)
+        writer = ad_common.S3Writer(s3_client, bucket, s3_key, process_data.metrics)
+        process_data.WRITERS[part_format](tables[name], process_data.TABLES[name]['csv_header'], writer)
+
+        # Older rollups in another format and parts
+        response = s3_client.list_objects(Bucket=bucket, Prefix=str(date) + '/' + name + '.')
+        for content in response.get('Contents', []):
+            if content['Key'] != s3_key:
+                s3_client.delete_object(Bucket=bucket, Key=content['Key'])
+
+    process_data.invalidate_rollups(s3_client, bucket, date)
+
+def replay_data(start_date, end_date, archive_bucket, processed_bucket, options, workers=None, dry_run=False):
+    s3_client = boto3.client('s3')
+
+    segments = plan_segments(list_segments(s3_client, archive_bucket, start_date, end_date))
+    log(str(len(segments)) + " segments")
+    runs = segment_runs(segments)
+
+    dates = set()
+    date = start_date
+    while date <= end_date:
+        dates.add(str(date))
+        date += ONE_DAY
+
+    pool = multiprocessing.Pool(workers)
+    tables = dict()
+    spans = dict()
+    args = [(archive_bucket, s3_key, from_seq_num, to_seq_num, dates, options)
+            for s3_key, from_seq_num, to_seq_num in segments]
+    for n, (s3_key, first_date, last_date, result) in enumerate(pool.imap_unordered(replay_segment, args)):
+        for date in result:
+            add_tables(tables.setdefault(date, dict()), result[date])
+        if first_date:
+            span = spans.setdefault(runs[s3_key], [first_date, last_date])
+            span[0] = min(span[0], first_date)
+            span[1] = max(span[1], last_date)
+        if (n + 1) % 100 == 0:
+            log(str(n + 1) + " segments replayed")
+    pool.close()
+    pool.join()
+
+    for date in sorted(tables):
+        log(date + " " + str(sum(tables[date]['single']['total'].values())) + " single counts")
+        # Replacing a day with only part of its matches would lose the rest
+        if not any(first_date < date < last_date for first_date, last_date in spans.values()):
+            log(date + " is not covered by the archive from the day before to the day after, not replacing it")
+            del tables[date]
+            continue
+        if not dry_run:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            upload_day(s3_client, processed_bucket, date, tables[str(date)], options['part_format'])
+
+    return tables
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild day rollups from the raw page archive")
+    parser.add_argument('start_date', type=parse_date)
+    parser.add_argument('end_date', type=parse_date)
+    parser.add_argument('--archive-bucket', default=get_data.RAW_ARCHIVE)
+    parser.add_argument('--processed-bucket')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--aggregator', default=process_data.AGGREGATOR)
+    parser.add_argument('--part-format', default=process_data.PART_FORMAT)
+    parser.add_argument('--match-encoding', default=get_data.MATCH_ENCODING)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    # Dates still being processed would get parts on top of their rollups
+    dynamodb = boto3.resource('dynamodb')
+    response = dynamodb.Table('ad-metadata').get_item(
+        Key={
+            'role': 'processed'
+        }
+    )
+    processed_date = parse_date(response['Item']['date'])
+    if args.end_date >= processed_date:
+        raise Exception("end_date must be before the processed date " + str(processed_date))
+
+    options = {
+        'aggregator': args.aggregator,
+        'part_format': args.part_format,
+        'match_encoding': args.match_encoding,
+    }
+
+    log('Enter')
+    replay_data(args.start_date, args.end_date, args.archive_bucket,
+                args.processed_bucket or response['Item']['s3bucket'],
+                options, args.workers, args.dry_run)
+    log('Exit')
@@ -0,0 +1,671 @@
+#!/usr/bin/python
+
+import boto3
+import os
+import imp
+import time
+import datetime
+import tempfile
+import shutil
+import random
+import collections
+import urlparse
+import threading
+import unittest
+import BaseHTTPServer
+
+import moto
+
+# Offline tests of get-data.py, process-data.py and publish-data.py against
+# the stand-ins of benchmark-data.py: moto for DynamoDB and S3, and a local
+# HTTP server serving synthetic Steam API pages. Run as python test-data.py.
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+benchmark_data = imp.load_source('benchmark_data', os.path.join(PATH, 'benchmark-data.py'))
+get_data = benchmark_data.get_data
+process_data = benchmark_data.process_data
+publish_data = benchmark_data.publish_data
+
+FIRST_SEQ_NUM = benchmark_data.FIRST_SEQ_NUM
+DATE = datetime.date(2016, 1, 1)
+API_KEYS = ['key%d' % i for i in range(4)]
+
+# moto takes any credentials, but boto3 wants some
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+class RecordingApiStub(benchmark_data.ApiStub):
+    ''' ApiStub recording the (key, seq num, time) of each request '''
+    requests = list()
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        self.requests.append((query['key'][0], int(query['start_at_match_seq_num'][0]), time.time()))
+        benchmark_data.ApiStub.do_GET(self)
+
+class ThrottlingApiStub(RecordingApiStub):
+    ''' RecordingApiStub answering the requests made with some keys with
+    an HTTP error status '''
+    statuses = dict()
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        status = self.statuses.get(query['key'][0])
+        if status is None:
+            return RecordingApiStub.do_GET(self)
+        self.requests.append((query['key'][0], int(query['start_at_match_seq_num'][0]), time.time()))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+def start_api_stub(handler):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/IDOTA2Match_570' % server.server_port
+
+class LambdaContext(object):
+    ''' Enough of a Lambda context for the handlers to invoke themselves '''
+    function_name = 'get-data'
+    aws_request_id = 'test'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+def decoded_matches(seq_nums, rnd):
+    ''' Synthetic matches as process-data.py decodes them from ad-data '''
+    encode_match = get_data.MATCH_ENCODINGS['compact']
+    matches = list()
+    for seq_num in seq_nums:
+        match = benchmark_data.make_match(seq_num, rnd)
+        match['date'] = str(DATE)
+        matches.append(process_data.decode_match(encode_match(match)))
+    return matches
+
+class ShardTest(unittest.TestCase):
+    ''' Sharded ingestion by get-data.py '''
+    def setUp(self):
+        self.mocks = [moto.mock_dynamodb2(), moto.mock_lambda()]
+        for mock in self.mocks:
+            mock.start()
+        self.metadata_table = benchmark_data.create_tables().Table('ad-metadata')
+        self.metadata_table.put_item(Item={'role': 'latest_seq_num', 'match_seq_num': FIRST_SEQ_NUM, 'end_time': 0})
+        self.metadata_table.put_item(Item={'role': 'dota_api_key', 'dota_api_keys': API_KEYS})
+
+        self.server, get_data.API_URL = start_api_stub(RecordingApiStub)
+        RecordingApiStub.requests = list()
+        get_data.TIMEOUT = 60
+        # Matches end an hour before now, so the backlog only looks far
+        # behind from the initial cursor
+        self.first_start_time = benchmark_data.FIRST_START_TIME
+        benchmark_data.FIRST_START_TIME = int(time.time()) - 2*60*60
+
+    def tearDown(self):
+        benchmark_data.FIRST_START_TIME = self.first_start_time
+        # The stub serves one connection at a time, drop the pooled one
+        for idle in get_data.api_client.pool.values():
+            for conn in idle:
+                conn.close()
+        get_data.api_client.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        for mock in self.mocks:
+            mock.stop()
+
+    def cursor(self):
+        return int(self.metadata_table.get_item(Key={'role': 'latest_seq_num'})['Item']['match_seq_num'])
+
+    def shards(self):
+        return dict((shard['role'], shard) for shard in get_data.load_shards(self.metadata_table))
+
+    def put_shard(self, start, end, key_slot, **attributes):
+        shard = {
+            'role': 'shard-%020d' % start,
+            'start_seq_num': start,
+            'end_seq_num': end,
+            'match_seq_num': start,
+            'end_time': 0,
+            'done': False,
+            'at_head': False,
+            'lease_expires': 0,
+            'key_slot': key_slot,
+            'key_slots': 2,
+        }
+        shard.update(attributes)
+        self.metadata_table.put_item(Item=shard)
+        return shard['role']
+
+    def test_not_sharded_by_default(self):
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 200
+        get_data.lambda_handler({})
+        self.assertEqual(self.shards(), {})
+        self.assertEqual(self.cursor(), FIRST_SEQ_NUM + 200)
+
+    def test_cursor_reaches_head(self):
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 450
+        event = {'shard_workers': 2, 'shard_seq_nums': 300}
+
+        # Two shards, the second one past the head and left unfinished at it
+        get_data.lambda_handler(event)
+        shards = self.shards()
+        self.assertEqual(sorted(shards), ['shard-%020d' % FIRST_SEQ_NUM, 'shard-%020d' % (FIRST_SEQ_NUM + 300)])
+        last = shards['shard-%020d' % (FIRST_SEQ_NUM + 300)]
+        self.assertFalse(last['done'])
+        self.assertTrue(last['at_head'])
+        self.assertEqual(last['match_seq_num'], FIRST_SEQ_NUM + 450)
+
+        # The cursor goes through the finished shard to the head, and the
+        # shards are dropped rather than added past the head
+        get_data.lambda_handler(event)
+        self.assertEqual(self.cursor(), FIRST_SEQ_NUM + 450)
+        self.assertEqual(self.shards(), {})
+
+        # The next run is close enough to ingest inline
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 500
+        get_data.lambda_handler(event)
+        self.assertEqual(self.shards(), {})
+        self.assertEqual(self.cursor(), FIRST_SEQ_NUM + 500)
+
+    def test_cursor_follows_unfinished_shard(self):
+        self.put_shard(FIRST_SEQ_NUM, FIRST_SEQ_NUM + 300, 0, match_seq_num=FIRST_SEQ_NUM + 120,
+                       end_time=1, lease_expires=int(time.time()) + 600)
+        get_data.lambda_handler({'shard_workers': 2, 'shard_seq_nums': 300})
+        self.assertEqual(self.cursor(), FIRST_SEQ_NUM + 120)
+        self.assertIn('shard-%020d' % FIRST_SEQ_NUM, self.shards())
+
+    def test_key_slots_kept(self):
+        # The first shard is done, the second still leased by its worker
+        self.put_shard(FIRST_SEQ_NUM, FIRST_SEQ_NUM + 300, 0, match_seq_num=FIRST_SEQ_NUM + 300,
+                       end_time=1, done=True)
+        leased = self.put_shard(FIRST_SEQ_NUM + 300, FIRST_SEQ_NUM + 600, 1,
+                                lease_expires=int(time.time()) + 600)
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 900
+        get_data.lambda_handler({'shard_workers': 2, 'shard_seq_nums': 300})
+
+        shards = self.shards()
+        added = 'shard-%020d' % (FIRST_SEQ_NUM + 600)
+        self.assertEqual(sorted(shards), [leased, added])
+        self.assertEqual(shards[leased]['key_slot'], 1)
+        self.assertEqual(shards[added]['key_slot'], 0)
+        self.assertTrue(shards[added]['done'])
+        # The added shard was worked with the keys of its slot only
+        keys = set(request[0] for request in RecordingApiStub.requests)
+        self.assertTrue(keys)
+        self.assertTrue(keys <= set(API_KEYS[0::2]))
+
+    def test_invoke_failure_works_inline(self):
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 300
+        # No such function to invoke, the shards are worked here
+        get_data.lambda_handler({'shard_workers': 2, 'shard_seq_nums': 300}, LambdaContext())
+        shards = self.shards()
+        self.assertTrue(shards['shard-%020d' % FIRST_SEQ_NUM]['done'])
+
+class FusedTest(unittest.TestCase):
+    ''' Part files of get-data.py's fused mode against those of
+    process-data.py reading the same matches from ad-data '''
+    def setUp(self):
+        self.mocks = [moto.mock_dynamodb2(), moto.mock_s3()]
+        for mock in self.mocks:
+            mock.start()
+        metadata_table = benchmark_data.create_tables().Table('ad-metadata')
+        metadata_table.put_item(Item={'role': 'latest_seq_num', 'match_seq_num': FIRST_SEQ_NUM, 'end_time': 0})
+        metadata_table.put_item(Item={'role': 'dota_api_key', 'dota_api_keys': API_KEYS})
+        metadata_table.put_item(Item={'role': 'processed', 's3bucket': 'ad-fused'})
+        self.s3_client = boto3.client('s3')
+        for bucket in ['ad-fused', 'ad-processed']:
+            self.s3_client.create_bucket(Bucket=bucket)
+
+        self.server, get_data.API_URL = start_api_stub(RecordingApiStub)
+        get_data.TIMEOUT = 60
+        self.first_start_time = benchmark_data.FIRST_START_TIME
+        benchmark_data.FIRST_START_TIME = int(time.time()) - 2*60*60
+        self.match_projection = process_data.match_projection
+        process_data.match_projection = benchmark_data.flat_projection
+
+    def tearDown(self):
+        process_data.match_projection = self.match_projection
+        benchmark_data.FIRST_START_TIME = self.first_start_time
+        for idle in get_data.api_client.pool.values():
+            for conn in idle:
+                conn.close()
+        get_data.api_client.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        for mock in self.mocks:
+            mock.stop()
+
+    def parts(self, bucket):
+        ''' {(date, table): contents} of the part files in bucket '''
+        parts = dict()
+        for content in self.s3_client.list_objects(Bucket=bucket).get('Contents', []):
+            date, filename = content['Key'].split('/')
+            table = filename.split('.')[0]
+            self.assertNotIn((date, table), parts)
+            parts[(date, table)] = self.s3_client.get_object(Bucket=bucket, Key=content['Key'])['Body'].read()
+        return parts
+
+    def test_same_parts(self):
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + 300
+        get_data.lambda_handler({'fused': True})
+        fused = self.parts('ad-fused')
+        self.assertTrue(fused)
+
+        options = {
+            'aggregator': process_data.AGGREGATOR,
+            'page_size': process_data.QUERY_PAGE_SIZE,
+            'part_format': process_data.PART_FORMAT,
+        }
+        for date in set(date for date, _ in fused):
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            process_data.process_date(date, 0, process_data.Deadline(None, time.time(), 3600), 'ad-processed', options)
+        processed = self.parts('ad-processed')
+
+        self.assertEqual(sorted(fused), sorted(processed))
+        for part in sorted(fused):
+            self.assertTrue(fused[part] == processed[part], str(part) + ' differs')
+
+class KeySchedulerTest(unittest.TestCase):
+    ''' API key scheduling by get-data.py '''
+    def setUp(self):
+        self.server, get_data.API_URL = start_api_stub(ThrottlingApiStub)
+        ThrottlingApiStub.requests = list()
+        ThrottlingApiStub.statuses = dict()
+        # Small pages, the requests are what is measured
+        benchmark_data.ApiStub.head_seq_num = FIRST_SEQ_NUM + get_data.API_MIN_PAGE_SIZE
+
+    def tearDown(self):
+        for idle in get_data.api_client.pool.values():
+            for conn in idle:
+                conn.close()
+        get_data.api_client.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, scheduler, n_pages):
+        ''' Seconds taken to fetch n_pages and when each request was made by key '''
+        deadline = get_data.Deadline(None, time.time(), 60)
+        stop_event = threading.Event()
+        n_requests = len(ThrottlingApiStub.requests)
+        start_time = time.time()
+        for page in range(n_pages):
+            self.assertIsNotNone(get_data.fetch_page(FIRST_SEQ_NUM, scheduler, deadline, stop_event))
+        seconds = time.time() - start_time
+
+        times = dict()
+        for key, seq_num, request_time in ThrottlingApiStub.requests[n_requests:]:
+            times.setdefault(key, list()).append(request_time)
+        return seconds, times
+
+    def test_rate_limit(self):
+        scheduler = get_data.KeyScheduler(API_KEYS[:2], rate=20, burst=1)
+        seconds, times = self.fetch(scheduler, 21)
+        # One token up front and 20 a second for each key
+        self.assertTrue(seconds >= 19 / 40.0)
+        self.assertEqual(sorted(times), API_KEYS[:2])
+        for key in times:
+            for before, after in zip(times[key], times[key][1:]):
+                self.assertTrue(after - before >= 1 / 20.0 - 0.01)
+
+    def test_throttled_key_backs_off(self):
+        ThrottlingApiStub.statuses = {API_KEYS[0]: 429, API_KEYS[1]: 403}
+        scheduler = get_data.KeyScheduler(API_KEYS[:3], rate=20, burst=1)
+        _, times = self.fetch(scheduler, 30)
+        self.assertEqual(len(times[API_KEYS[2]]), 30)
+
+        # The throttled key is retried after 1s, then 2s and so on; the
+        # refused one only after KEY_MAX_BACKOFF. How many retries fit in
+        # the run depends on the machine, the gaps between them don't.
+        throttled = scheduler.keys[API_KEYS[0]]
+        attempts = times[API_KEYS[0]]
+        for i, (before, after) in enumerate(zip(attempts, attempts[1:])):
+            self.assertTrue(after - before >= min(2 ** i, get_data.KEY_MAX_BACKOFF))
+        self.assertEqual(throttled['backoff'], min(2 ** (len(attempts) - 1), get_data.KEY_MAX_BACKOFF))
+        self.assertTrue(throttled['blocked_until'] >= attempts[-1] + throttled['backoff'])
+        self.assertTrue(throttled['throttles'] > 0 and throttled['errors'] == 0)
+
+        refused = scheduler.keys[API_KEYS[1]]
+        attempts = times[API_KEYS[1]]
+        for before, after in zip(attempts, attempts[1:]):
+            self.assertTrue(after - before >= get_data.KEY_MAX_BACKOFF)
+        self.assertEqual(refused['backoff'], get_data.KEY_MAX_BACKOFF)
+        self.assertTrue(refused['blocked_until'] >= attempts[-1] + get_data.KEY_MAX_BACKOFF)
+        self.assertTrue(refused['errors'] > 0)
+
+        # A healthy key is preferred over a throttled one that is ready again
+        throttled['blocked_until'] = 0
+        ThrottlingApiStub.statuses = dict()
+        n_requests = len(ThrottlingApiStub.requests)
+        self.fetch(scheduler, 1)
+        self.assertEqual(ThrottlingApiStub.requests[n_requests][0], API_KEYS[2])
+
+class DecodeTest(unittest.TestCase):
+    ''' Matches as read by process-data.py '''
+    def test_ids_too_large(self):
+        match = benchmark_data.make_match(FIRST_SEQ_NUM, random.Random(0))
+        match['date'] = '2016-01-01'
+        encode_match = get_data.MATCH_ENCODINGS['compact']
+        self.assertTrue(process_data.decode_match(encode_match(match))[2])
+
+        process_data.metrics.pop()
+        for attribute, value in [('hero_id', 1 << 16), ('item_0', 1 << 20)]:
+            player = dict(match['players'][3])
+            player[attribute] = value
+            broken = dict(match, players=match['players'][:3] + [player] + match['players'][4:])
+            for encoded in [broken, encode_match(broken)]:
+                self.assertEqual(process_data.decode_match(encoded), (match['radiant_win'], [], False))
+        counters, histograms = process_data.metrics.pop()
+        self.assertEqual(counters['InvalidIds'][0], 4)
+
+@unittest.skipIf(process_data.numpy is None, 'numpy is not installed')
+class AggregatorTest(unittest.TestCase):
+    ''' NumpyAggregator against CounterAggregator '''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_same_csv(self):
+        rnd = random.Random(0)
+        encode_match = get_data.MATCH_ENCODINGS['compact']
+        batches = list()
+        for batch in range(3):
+            matches = list()
+            for seq_num in range(FIRST_SEQ_NUM + 200 * batch, FIRST_SEQ_NUM + 200 * (batch + 1)):
+                match = benchmark_data.make_match(seq_num, rnd)
+                match['date'] = str(DATE)
+                if seq_num % 17 == 0:
+                    # Invalid, the players before it still count
+                    del match['players'][rnd.randint(0, 9)]['ability_upgrades']
+                if batch == 2 and seq_num % 5 == 0:
+                    # Ids first seen in the last batch
+                    player = match['players'][rnd.randint(0, 9)]
+                    player['hero_id'] = benchmark_data.N_HEROES + 1 + seq_num % 3
+                    player['item_0'] = benchmark_data.N_ITEMS + 1 + seq_num % 7
+                    player['ability_upgrades'][0]['ability'] = benchmark_data.FIRST_ABILITY + benchmark_data.N_ABILITIES + seq_num % 11
+                matches.append(process_data.decode_match(encode_match(match)))
+            batches.append(matches)
+
+        aggregators = {'counter': process_data.CounterAggregator(), 'numpy': process_data.NumpyAggregator()}
+        for matches in batches:
+            for aggregator in aggregators.values():
+                aggregator.add_matches(matches)
+
+        tables = dict((kind, aggregator.tables()) for kind, aggregator in aggregators.items())
+        for name, table in process_data.TABLES.items():
+            contents = dict()
+            for kind in tables:
+                filename = os.path.join(self.temp_dir, kind + '-' + name + '.csv')
+                process_data.write_csv(tables[kind][name], table['csv_header'], filename)
+                with open(filename, 'rb') as fd:
+                    contents[kind] = fd.read()
+            self.assertTrue(contents['counter'] == contents['numpy'], name + ' differs')
+
+class PartFormatTest(unittest.TestCase):
+    ''' Part files of process-data.py as publish-data.py reads them '''
+    def setUp(self):
+        self.mock = moto.mock_s3()
+        self.mock.start()
+        self.s3_client = boto3.client('s3')
+        self.s3_client.create_bucket(Bucket='ad-processed')
+        self.temp_dir = tempfile.mkdtemp()
+        self.block_rows = process_data.ad_common.PACKED_BLOCK_ROWS
+
+    def tearDown(self):
+        process_data.ad_common.PACKED_BLOCK_ROWS = self.block_rows
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        self.mock.stop()
+
+    def test_round_trip(self):
+        aggregator = process_data.CounterAggregator()
+        aggregator.add_matches(decoded_matches(range(FIRST_SEQ_NUM, FIRST_SEQ_NUM + 200), random.Random(0)))
+        tables = aggregator.tables()
+        # Packed files of several blocks
+        process_data.ad_common.PACKED_BLOCK_ROWS = 100
+        for part_format, extension in sorted(process_data.FORMAT_EXTENSIONS.items()):
+            process_data.upload_parts(aggregator, DATE, 0, 200, 'ad-processed', part_format)
+            for name, table in sorted(tables.items()):
+                filename = os.path.join(self.temp_dir, name + extension)
+                s3_key = str(DATE) + '/' + name + '.part0-200' + extension
+                self.s3_client.download_file('ad-processed', s3_key, filename)
+                header, rows = publish_data.read_table(filename)
+                self.assertEqual(header, process_data.TABLES[name]['csv_header'] + ',total,wins\n')
+                self.assertRowsEqual(rows, publish_data.table_rows(table))
+
+    def assertRowsEqual(self, rows, expected):
+        # Row by row, a diff of the whole lists takes minutes
+        rows = list(rows)
+        expected = list(expected)
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            self.assertEqual(tuple(row), tuple(expected_row))
+
+class WindowPublishTest(unittest.TestCase):
+    ''' Publishes of publish-data.py updated from the previous one against
+    publishes merged from the whole window '''
+    def setUp(self):
+        self.mocks = [moto.mock_dynamodb2(), moto.mock_s3()]
+        for mock in self.mocks:
+            mock.start()
+        benchmark_data.create_tables()
+        self.s3_client = boto3.client('s3')
+        for bucket in ['ad-processed', 'ad-publish', 'ad-publish-full']:
+            self.s3_client.create_bucket(Bucket=bucket)
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.object_caches = publish_data.object_caches
+        publish_data.object_caches = dict(
+            (table, publish_data.ObjectCache(os.path.join(self.temp_dir, table), publish_data.CACHE_BYTES))
+            for table in publish_data.TABLES)
+
+        for day in range(9):
+            self.upload_part(DATE + datetime.timedelta(days=day), 0, 20)
+
+    def tearDown(self):
+        publish_data.object_caches = self.object_caches
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        for mock in self.mocks:
+            mock.stop()
+
+    def upload_part(self, date, seq_num, process_seq_num):
+        aggregator = process_data.CounterAggregator()
+        seq_nums = range(FIRST_SEQ_NUM + seq_num, FIRST_SEQ_NUM + process_seq_num)
+        aggregator.add_matches(decoded_matches(seq_nums, random.Random(str(date) + str(seq_num))))
+        process_data.upload_parts(aggregator, date, seq_num, process_seq_num, 'ad-processed', 'csv')
+
+    def publish(self, bucket, start_date, end_date, previous=None):
+        publish_data.publish_data(start_date, end_date, 'ad-processed', bucket, 'example.com',
+                                  concurrency=2, previous=previous, workers=1)
+
+    def assertSamePublish(self, start_date, end_date):
+        for table in publish_data.TABLES:
+            s3_key = publish_data.publish_key(start_date, end_date, table)
+            incremental = self.s3_client.get_object(Bucket='ad-publish', Key=s3_key)['Body'].read()
+            full = self.s3_client.get_object(Bucket='ad-publish-full', Key=s3_key)['Body'].read()
+            self.assertTrue(incremental == full, table + ' differs')
+
+    def rollups(self, previous):
+        return dict((table, publish_data.load_rollups(table, previous, 'ad-processed', self.s3_client))
+                    for table in publish_data.TABLES)
+
+    def test_slide(self):
+        previous = (DATE, DATE + datetime.timedelta(days=7))
+        self.publish('ad-publish', *previous)
+
+        start_date, end_date = DATE + datetime.timedelta(days=1), DATE + datetime.timedelta(days=8)
+        self.assertTrue(publish_data.window_ranges(start_date, end_date, previous))
+        self.assertNotIn(None, self.rollups(previous).values())
+        self.publish('ad-publish', start_date, end_date, previous)
+        self.publish('ad-publish-full', start_date, end_date)
+        self.assertSamePublish(start_date, end_date)
+
+    def test_late_part(self):
+        previous = (DATE, DATE + datetime.timedelta(days=7))
+        self.publish('ad-publish', *previous)
+
+        # A late part of a day in both windows deletes the rollups holding
+        # it, the update starts over from the whole window
+        self.upload_part(DATE + datetime.timedelta(days=4), 20, 30)
+        self.assertEqual(set(self.rollups(previous).values()), set([None]))
+
+        start_date, end_date = DATE + datetime.timedelta(days=1), DATE + datetime.timedelta(days=8)
+        self.publish('ad-publish', start_date, end_date, previous)
+        self.publish('ad-publish-full', start_date, end_date)
+        self.assertSamePublish(start_date, end_date)
+
+    def test_subtract_too_much(self):
+        rnd = random.Random(0)
+        filenames = list()
+        for i in range(2):
+            aggregator = process_data.CounterAggregator()
+            aggregator.add_matches(decoded_matches(range(FIRST_SEQ_NUM, FIRST_SEQ_NUM + 20 * (i + 1)), rnd))
+            filenames.append(os.path.join(self.temp_dir, 'hero%d.csv' % i))
+            process_data.write_csv(aggregator.tables()['hero'], process_data.TABLES['hero']['csv_header'], filenames[-1])
+
+        merge_mode = publish_data.MERGE_MODE
+        try:
+            for mode in ['stream', 'memory']:
+                publish_data.MERGE_MODE = mode
+                with self.assertRaises(publish_data.InconsistentCounts):
+                    publish_data.merge_csv(filenames[:1], os.path.join(self.temp_dir, 'out.csv'),
+                                           subtract_files=filenames[1:])
+        finally:
+            publish_data.MERGE_MODE = merge_mode
+
+class MergeTest(unittest.TestCase):
+    ''' merge_csv of publish-data.py '''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.merge_mode = publish_data.MERGE_MODE
+        self.merge_in_memory = publish_data.merge_in_memory
+
+    def tearDown(self):
+        publish_data.MERGE_MODE = self.merge_mode
+        publish_data.merge_in_memory = self.merge_in_memory
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_unsorted_fallback(self):
+        rnd = random.Random(0)
+        full_header = process_data.TABLES['item']['csv_header'] + ',total,wins\n'
+        merged = {'total': collections.Counter(), 'wins': collections.Counter()}
+        filenames = list()
+        for i in range(3):
+            table = {'total': dict(), 'wins': dict()}
+            for _ in range(1000):
+                key = publish_data.pack_key(rnd.randint(0, 300), rnd.randint(0, 300))
+                table['total'][key] = rnd.randint(1, 20)
+                table['wins'][key] = rnd.randint(0, table['total'][key])
+            merged['total'].update(table['total'])
+            merged['wins'].update(table['wins'])
+
+            rows = list(publish_data.table_rows(table))
+            if i == 1:
+                # Written before keys were sorted
+                rnd.shuffle(rows)
+            filenames.append(os.path.join(self.temp_dir, 'item%d.csv' % i))
+            publish_data.write_csv_rows(rows, filenames[-1], full_header)
+
+        # The streaming inputs are closed before merging in memory
+        open_fds = list()
+        def merge_in_memory(*args):
+            open_fds.append(len(os.listdir('/proc/self/fd')))
+            return self.merge_in_memory(*args)
+        publish_data.merge_in_memory = merge_in_memory
+        publish_data.MERGE_MODE = 'stream'
+        n_fds = len(os.listdir('/proc/self/fd'))
+        out_file = os.path.join(self.temp_dir, 'out.csv')
+        publish_data.merge_csv(filenames, out_file)
+        self.assertEqual(open_fds, [n_fds])
+
+        header, rows = publish_data.read_table(out_file)
+        self.assertEqual(header, full_header)
+        self.assertTrue(list(rows) == list(publish_data.table_rows(merged)))
+
+class RollupTreeTest(unittest.TestCase):
+    ''' The rollup tree of ad-common.py as publish-data.py splits ranges over
+    it and process-data.py invalidates it '''
+    first_date = datetime.date(2015, 12, 1)
+    last_date = datetime.date(2017, 3, 31)
+
+    def dates(self, start_date, end_date):
+        return [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+    def nodes(self):
+        ''' Every node of the years from first_date to last_date '''
+        nodes = list()
+        stack = [(datetime.date(year, 1, 1), 'year') for year in range(self.first_date.year, self.last_date.year + 1)]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack += publish_data.node_children(node)
+        return nodes
+
+    def test_split_date_ranges(self):
+        rnd = random.Random(0)
+        dates = self.dates(self.first_date, self.last_date)
+        ranges = [(self.first_date, self.last_date)] + [sorted(rnd.sample(dates, 2)) for _ in range(200)]
+        for start_date, end_date in ranges:
+            covered = list()
+            for node in publish_data.split_date_ranges(start_date, end_date):
+                covered += self.dates(node[0], publish_data.node_end(node))
+            self.assertEqual(covered, self.dates(start_date, end_date))
+
+    def test_rollup_ancestors(self):
+        nodes = [node for node in self.nodes() if node[1] != 'day']
+        for date in self.dates(self.first_date, self.last_date):
+            holding = set(publish_data.node_name(node) for node in nodes
+                          if node[0] <= date <= publish_data.node_end(node))
+            self.assertEqual(set(process_data.rollup_ancestors(date)), holding)
+
+class SketchTest(unittest.TestCase):
+    ''' SketchAggregator against the exact CounterAggregator '''
+    def test_bounds(self):
+        rnd = random.Random(0)
+        encode_match = get_data.MATCH_ENCODINGS['compact']
+        exact = process_data.CounterAggregator()
+        sketch = process_data.SketchAggregator(capacity=500)
+        process_data.metrics.pop()
+        heavy_ability = benchmark_data.FIRST_ABILITY
+        for batch in range(10):
+            matches = list()
+            for seq_num in range(FIRST_SEQ_NUM + 100 * batch, FIRST_SEQ_NUM + 100 * (batch + 1)):
+                match = benchmark_data.make_match(seq_num, rnd)
+                match['date'] = '2016-01-01'
+                radiant_win, players, valid = process_data.decode_match(encode_match(match))
+                # A heavy (ability, item) key and (ability, ability) key
+                players[0][2].update([heavy_ability, heavy_ability + 1])
+                players[0][3].add(1)
+                matches.append((radiant_win, players, valid))
+            exact.add_matches(matches)
+            sketch.add_matches(matches)
+        counters, histograms = process_data.metrics.pop()
+
+        heavy_keys = {
+            'item': (heavy_ability << process_data.KEY_BITS) | 1,
+            'combo': (heavy_ability << process_data.KEY_BITS) | (heavy_ability + 1),
+        }
+        for table in process_data.TABLES:
+            exact_table = exact.tables()[table]
+            sketch_table = sketch.tables()[table]
+            if table not in process_data.SKETCH_TABLES:
+                self.assertEqual(sketch_table, exact_table)
+                continue
+
+            error = counters['SketchError' + table.title()][0]
+            n_games = sum(exact_table['total'].itervalues())
+            self.assertTrue(0 < error <= n_games / (sketch.capacity + 1))
+            for key, total in exact_table['total'].iteritems():
+                estimate = sketch_table['total'].get(key, 0)
+                self.assertTrue(total - error <= estimate <= total)
+                wins = sketch_table['wins'].get(key, 0)
+                self.assertTrue(exact_table['wins'][key] - error <= wins <= exact_table['wins'][key])
+                if total > error:
+                    self.assertIn(key, sketch_table['total'])
+            self.assertTrue(exact_table['total'][heavy_keys[table]] > error)
+            self.assertIn(heavy_keys[table], sketch_table['total'])
+
+if __name__ == '__main__':
+    unittest.main()